@@ -0,0 +1,132 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Benchmark of concurrent weather command throughput, blocking HTTP calls (how every command worked before
+# the async client) vs the async OWMClient. No token or API key is needed, OWM is replaced by a local stub
+# with a fixed response latency. Run it from MainCode: python benchmarkOwm.py --commands 50 --latency 0.2
+
+#region Imports
+import argparse
+import asyncio
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+from aiohttp import web
+import owmClient
+from owmClient import CURRENT_WEATHER_PATH, GEOCODING_PATH, OWMClient
+
+#endregion
+#region Stub Server
+
+# Function to serve fake geocoding and current weather responses after `latency` seconds, on its own thread and loop
+def start_stub_server(port, latency):
+    async def geocode(request):
+        await asyncio.sleep(latency)
+        index = int(request.query['q'].split()[-1])
+        return web.json_response([{'name': request.query['q'], 'lat': index * 0.1, 'lon': index * 0.1, 'country': 'CA'}])
+
+    async def weather(request):
+        await asyncio.sleep(latency)
+        return web.json_response({
+            'name': 'Stub', 'dt': int(time.time()), 'timezone': 0,
+            'weather': [{'main': 'Clear', 'description': 'clear sky'}],
+            'main': {'temp': 293.15, 'humidity': 50}, 'wind': {'speed': 1.0, 'deg': 90}, 'sys': {},
+        })
+
+    ready = threading.Event()
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get(GEOCODING_PATH, geocode)
+        app.router.add_get(CURRENT_WEATHER_PATH, weather)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+
+#endregion
+#region Commands
+
+# Function to fetch the weather the way commands used to, with a blocking HTTP call inside the coroutine
+async def blocking_command(base_url, location):
+    query = urllib.parse.urlencode({'q': location, 'appid': 'benchmark'})
+    with urllib.request.urlopen(f'{base_url}{GEOCODING_PATH}?{query}') as response:
+        geocoding_data = json.load(response)
+    query = urllib.parse.urlencode({'lat': geocoding_data[0]['lat'], 'lon': geocoding_data[0]['lon'], 'appid': 'benchmark'})
+    with urllib.request.urlopen(f'{base_url}{CURRENT_WEATHER_PATH}?{query}') as response:
+        return json.load(response)
+
+async def async_command(owm, location):
+    return await owm.current_weather(location)
+
+# Function to measure how late a 50 ms timer fires while commands run, this is what delays gateway heartbeats
+async def measure_loop_lag(stop):
+    worst = 0.0
+    while not stop.is_set():
+        start = time.monotonic()
+        await asyncio.sleep(0.05)
+        worst = max(worst, time.monotonic() - start - 0.05)
+    return worst
+
+# Function to run `commands` concurrent commands, each for a different location so caching can't help
+async def run_commands(command, commands):
+    stop = asyncio.Event()
+    lag = asyncio.ensure_future(measure_loop_lag(stop))
+    start = time.monotonic()
+    await asyncio.gather(*(command(f'Benchmark City {index}') for index in range(commands)))
+    elapsed = time.monotonic() - start
+    stop.set()
+    return elapsed, await lag
+
+#endregion
+#region Main
+
+async def main(commands, latency, port):
+    base_url = f'http://127.0.0.1:{port}'
+    start_stub_server(port, latency)
+
+    before, before_lag = await run_commands(lambda location: blocking_command(base_url, location), commands)
+
+    owmClient.OWM_BASE_URL = base_url
+    owm = OWMClient('benchmark', calls_per_minute=1000000)
+    await owm.open()
+    try:
+        after, after_lag = await run_commands(lambda location: async_command(owm, location), commands)
+    finally:
+        await owm.close()
+
+    print(f"{commands} concurrent commands, {latency * 1000:.0f} ms per OWM call")
+    print(f"Blocking: {before:.2f}s ({commands / before:.1f} commands/s), worst event loop stall {before_lag * 1000:.0f} ms")
+    print(f"Async:    {after:.2f}s ({commands / after:.1f} commands/s), worst event loop stall {after_lag * 1000:.0f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark concurrent weather command throughput against a local OWM stub')
+    parser.add_argument('--commands', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the stub waits before each response')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    asyncio.run(main(args.commands, args.latency, args.port))
+
+#endregion
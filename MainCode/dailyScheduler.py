@@ -0,0 +1,500 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import asyncio
+import concurrent.futures
+import datetime
+import glob
+import heapq
+import json
+import os
+import time
+import pytz
+from schedulerMetrics import SchedulerMetrics
+from schedulerShards import stable_hash
+
+#endregion
+#region Helper Functions
+
+# Function to pin a wall-clock time to the timezone, handling DST transitions:
+# a time skipped by spring-forward fires when the gap ends (02:30 -> 03:00), a repeated time fires on its first occurrence
+def localize_wall_time(tz, naive_time):
+    while True:
+        try:
+            return tz.localize(naive_time, is_dst=None)
+        except pytz.AmbiguousTimeError:
+            return tz.localize(naive_time, is_dst=True)
+        except pytz.NonExistentTimeError:
+            # Transitions happen on whole minutes, so the first minute that exists is the end of the gap
+            naive_time = naive_time.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+
+# Function to get the next UTC epoch (in whole seconds) after `after` at which HH:MM happens in the given timezone.
+# Dates are taken from the user's timezone, not the server's.
+def next_fire_time(update_time, timezone, after):
+    tz = pytz.timezone(timezone)
+    hour, minute = map(int, update_time.split(':'))
+    candidate_date = datetime.datetime.fromtimestamp(after, tz).date()
+
+    while True:
+        local_time = localize_wall_time(tz, datetime.datetime.combine(candidate_date, datetime.time(hour, minute)))
+        fire_time = int(local_time.timestamp())
+        if fire_time > after:
+            return fire_time
+        candidate_date += datetime.timedelta(days=1)
+
+# Function to get a user's smoothing offset in [-window, window] seconds, the same every day
+def smoothing_offset(user_id, window):
+    if window <= 0:
+        return 0
+    return stable_hash(f'smoothing:{user_id}') % (2 * window + 1) - window
+
+# Function to count how many sends land in each minute, returns {minute_epoch: count}
+def sends_per_minute(fire_times):
+    per_minute = {}
+    for fire_time in fire_times:
+        minute = fire_time - fire_time % 60
+        per_minute[minute] = per_minute.get(minute, 0) + 1
+    return per_minute
+
+# Function to bucket per-minute send counts into a histogram of burst sizes, like {'1': 12, '2-3': 4, '64-127': 1}
+def burst_histogram(per_minute):
+    histogram = {}
+    for count in sorted(per_minute.values()):
+        low = 1 << (count.bit_length() - 1)
+        label = str(low) if low == 1 else f'{low}-{2 * low - 1}'
+        histogram[label] = histogram.get(label, 0) + 1
+    return histogram
+
+# Seconds before a fire time that its prefetch should be finished by
+PREFETCH_MARGIN = 30
+
+#endregion
+#region Sent Ledger
+
+# Durable record of the last fire time each user was sent, written before the DMs go out
+# so a crash or restart can at worst skip an update, never send it twice.
+# Each tick appends one line with just its batch, and every compact_every batches the file is rewritten as a single line.
+# Writes run on a background thread so the fsync never blocks the event loop.
+# In worker mode each worker writes its own file and peer_pattern merges every worker's ledger on load.
+class SentLedger:
+    def __init__(self, path, peer_pattern=None, compact_every=1000):
+        self.path = path
+        self.peer_pattern = peer_pattern
+        self.compact_every = compact_every
+        self.appended = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.entries = self.load()
+
+    def load(self):
+        entries = {}
+        paths = glob.glob(self.peer_pattern) if self.peer_pattern else []
+        for path in [self.path] + [path for path in paths if path != self.path]:
+            try:
+                with open(path, 'r') as file:
+                    lines = file.read().splitlines()
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                try:
+                    batch = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from a crash mid-append, or a peer that is appending right now
+                    continue
+                for user_id, fire_time in batch.items():
+                    entries[user_id] = max(entries.get(user_id, 0), fire_time)
+        return entries
+
+    # Function to pick up what peers have sent (a slice may have moved here), reading runs on the writer thread.
+    # Batches recorded while reading are kept, they may not be in the files yet.
+    async def refresh(self):
+        loaded = await asyncio.get_event_loop().run_in_executor(self.executor, self.load)
+        for user_id, fire_time in self.entries.items():
+            loaded[user_id] = max(loaded.get(user_id, 0), fire_time)
+        self.entries = loaded
+
+    # Function to rewrite the whole ledger as one line
+    def save(self, entries):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(json.dumps(entries) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def _append(self, batch):
+        text = (json.dumps(batch) + '\n').encode()
+        with open(self.path, 'a+b') as file:
+            # Keep a torn line from a crash separate, so loading only skips that one
+            if file.seek(0, os.SEEK_END) > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    text = b'\n' + text
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def already_sent(self, user_id, fire_time):
+        return self.entries.get(user_id, 0) >= fire_time
+
+    # Function to record a batch of [(user_id, fire_time)] as sent, returns once it is on disk
+    async def record(self, due):
+        batch = {}
+        for user_id, fire_time in due:
+            self.entries[user_id] = fire_time
+            batch[user_id] = fire_time
+
+        loop = asyncio.get_event_loop()
+        self.appended += 1
+        if self.appended >= self.compact_every:
+            self.appended = 0
+            await loop.run_in_executor(self.executor, self.save, dict(self.entries))
+        else:
+            await loop.run_in_executor(self.executor, self._append, batch)
+
+#endregion
+#region Scheduler
+
+# Min-heap of each subscriber's next fire time, the loop sleeps until the earliest one is due.
+# The next fire time is stored with the subscription as 'next_update_utc', so ticks only compare integers.
+# Entries are never removed from the middle of the heap, stale ones are skipped when popped.
+# Fire times missed while the bot was offline are replayed on load if they are within catchup_window seconds.
+# A stored fire time older than that (workers never save theirs) falls back to the most recent fire time
+# worked out from the settings, which is replayed if the ledger has no record of it being sent.
+# If prefetch is given, a second heap starts each fire time's prefetch prefetch_lead seconds ahead of it.
+# If owns is given, only the subscribers it returns True for are scheduled (used by sharded workers).
+# If smoothing_window is set, each user's fire time is moved by a fixed offset of up to that many seconds
+# either way, so subscriptions on round times don't all land in the same second.
+class DailyUpdateScheduler:
+    def __init__(self, send_updates, save=None, ledger=None, catchup_window=0, prefetch=None, prefetch_lead=0, owns=None,
+                 smoothing_window=0, metrics=None):
+        self.send_updates = send_updates  # coroutine called once per tick as send_updates([(user_id, fire_time), ...])
+        self.save = save  # called as save(user_ids) after those users' fire times change
+        self.ledger = ledger
+        self.catchup_window = catchup_window
+        self.caught_up = 0
+        self.prefetch = prefetch  # coroutine called as prefetch(user_ids, deadline)
+        self.prefetch_lead = prefetch_lead
+        self.prefetch_heap = []
+        self.prefetch_tasks = set()
+        self.owns = owns
+        self.smoothing_window = smoothing_window
+        self.metrics = metrics if metrics is not None else SchedulerMetrics()
+        self.data = {}
+        self.heap = []
+        self.fire_times = {}  # user_id -> next fire epoch
+        self.wakeup = None
+        self.task = None
+
+    @property
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    # Function to compute and store a user's next fire time, based on their saved subscription
+    def schedule(self, user_id, after=None):
+        user_data = self.data[user_id]
+        fire_time = self._next_fire_time(user_id, user_data, time.time() if after is None else after)
+        user_data['next_update_utc'] = fire_time
+        self._push(user_id, fire_time)
+
+    def _next_fire_time(self, user_id, user_data, after):
+        offset = smoothing_offset(user_id, self.smoothing_window)
+        # Look for the wall-clock time after (after - offset), so the smoothed time still lands after `after`
+        return next_fire_time(user_data['daily_update_time'], user_data['timezone'], after - offset) + offset
+
+    # Function to pick the fire time a user starts from on load, returns (fire_time, is_catch_up)
+    def _first_fire_time(self, user_id, user_data, now):
+        fire_time = user_data.get('next_update_utc')
+        if fire_time is None:
+            return self._next_fire_time(user_id, user_data, now), False
+        if fire_time > now:
+            return fire_time, False
+        if now - fire_time <= self.catchup_window:
+            if not self._already_sent(user_id, fire_time):
+                return fire_time, True
+        elif self.catchup_window > 0:
+            # The first fire time after the window opened is either the missed one or the next one
+            missed = self._next_fire_time(user_id, user_data, now - self.catchup_window)
+            if missed > now:
+                return missed, False
+            if not self._already_sent(user_id, missed):
+                return missed, True
+        return self._next_fire_time(user_id, user_data, now), False
+
+    def _load_user(self, user_id, user_data, now):
+        fire_time, is_catch_up = self._first_fire_time(user_id, user_data, now)
+        user_data['next_update_utc'] = fire_time
+        self._push(user_id, fire_time)
+        if is_catch_up:
+            # Missed while offline, fire it on the first tick
+            self.caught_up += 1
+
+    def _wants(self, user_id, user_data):
+        if 'daily_update_time' not in user_data or 'timezone' not in user_data:
+            return False
+        return self.owns is None or self.owns(user_id)
+
+    def _push(self, user_id, fire_time):
+        self.fire_times[user_id] = fire_time
+        heapq.heappush(self.heap, (fire_time, user_id))
+        if self.prefetch is not None:
+            heapq.heappush(self.prefetch_heap, (fire_time - self.prefetch_lead, fire_time, user_id))
+        self._wake()
+
+    # Function to remove a user's subscription
+    def unschedule(self, user_id):
+        self.data.get(user_id, {}).pop('next_update_utc', None)
+        self.fire_times.pop(user_id, None)
+        self._wake()
+
+    # Function to (re)build the schedule from the user data dictionary, reusing stored fire times that are still ahead
+    def load(self, data):
+        self.data = data
+        self.heap = []
+        self.prefetch_heap = []
+        self.fire_times = {}
+        now = time.time()
+        for user_id, user_data in data.items():
+            if not self._wants(user_id, user_data):
+                continue
+            try:
+                self._load_user(user_id, user_data, now)
+            except (ValueError, pytz.UnknownTimeZoneError) as e:
+                self.metrics.record_failure('invalid_settings', f'user {user_id}: {e}')
+
+    # Function to switch to freshly loaded user data without rebuilding the schedule: fire times are only
+    # worked out for users who weren't scheduled here before (new subscribers, slices taken over from
+    # another worker) or whose update time or timezone changed, everyone else keeps theirs
+    def refresh(self, data):
+        previous, self.data = self.data, data
+        now = time.time()
+        wanted = set()
+        for user_id, user_data in data.items():
+            if not self._wants(user_id, user_data):
+                continue
+            wanted.add(user_id)
+
+            fire_time = self.fire_times.get(user_id)
+            old_data = previous.get(user_id)
+            if (fire_time is not None and old_data is not None
+                    and old_data.get('daily_update_time') == user_data['daily_update_time']
+                    and old_data.get('timezone') == user_data['timezone']):
+                user_data['next_update_utc'] = fire_time
+                continue
+            try:
+                self._load_user(user_id, user_data, now)
+            except (ValueError, pytz.UnknownTimeZoneError) as e:
+                self.fire_times.pop(user_id, None)
+                self.metrics.record_failure('invalid_settings', f'user {user_id}: {e}')
+
+        # Unsubscribed, deleted, or in a slice that moved to another worker
+        for user_id in [user_id for user_id in self.fire_times if user_id not in wanted]:
+            del self.fire_times[user_id]
+        self._wake()
+
+    # Function to compare per-minute send bursts of the current schedule without and with smoothing
+    def burst_report(self):
+        before = sends_per_minute(fire_time - smoothing_offset(user_id, self.smoothing_window)
+                                  for user_id, fire_time in self.fire_times.items())
+        after = sends_per_minute(self.fire_times.values())
+        return {
+            'before': burst_histogram(before),
+            'after': burst_histogram(after),
+            'largest_before': max(before.values(), default=0),
+            'largest_after': max(after.values(), default=0),
+        }
+
+    def _already_sent(self, user_id, fire_time):
+        return self.ledger is not None and self.ledger.already_sent(user_id, fire_time)
+
+    def _wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    # Function to pop every subscription due at or before `now`, returns [(user_id, fire_time)]
+    def pop_due(self, now):
+        due = []
+        seen = set()
+        while self.heap and self.heap[0][0] <= now:
+            fire_time, user_id = heapq.heappop(self.heap)
+            # Skip entries left behind by a reschedule or unsubscribe, and a second push of the same fire time
+            if self.fire_times.get(user_id) != fire_time or user_id in seen:
+                continue
+            seen.add(user_id)
+            due.append((user_id, fire_time))
+        return due
+
+    # Function to get the earliest live fire time, or None if nobody is subscribed
+    def next_due(self):
+        while self.heap and self.fire_times.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    # Function to pop every fire time whose prefetch should start at or before `now`, returns [(user_id, fire_time)]
+    def pop_prefetch(self, now):
+        upcoming = []
+        while self.prefetch_heap and self.prefetch_heap[0][0] <= now:
+            _, fire_time, user_id = heapq.heappop(self.prefetch_heap)
+            if self.fire_times.get(user_id) == fire_time:
+                upcoming.append((user_id, fire_time))
+        return upcoming
+
+    def next_prefetch(self):
+        while self.prefetch_heap and self.fire_times.get(self.prefetch_heap[0][2]) != self.prefetch_heap[0][1]:
+            heapq.heappop(self.prefetch_heap)
+        return self.prefetch_heap[0][0] if self.prefetch_heap else None
+
+    def start(self):
+        if not self.is_running:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+            self.task.add_done_callback(self._run_done)
+
+    # run() only ends by being cancelled, anything else means daily updates have stopped
+    def _run_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.metrics.record_failure('scheduler_stopped', task.exception())
+            print(f"Daily update scheduler stopped unexpectedly: {task.exception()!r}")
+
+    def stop(self):
+        if self.is_running:
+            self.task.cancel()
+        for task in list(self.prefetch_tasks):
+            task.cancel()
+
+    async def run(self):
+        while True:
+            wake_times = [wake_time for wake_time in (self.next_due(), self.next_prefetch()) if wake_time is not None]
+            delay = max(0, min(wake_times) - time.time()) if wake_times else None
+
+            # Sleep until the next fire or prefetch time, or until a subscription changes
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            # One bad tick (a full disk, a failed save) must not end the loop
+            try:
+                self._start_prefetch(time.time())
+                await self._fire_due(time.time())
+            except Exception as e:
+                self.metrics.record_failure('tick_error', repr(e))
+
+    # Function to warm the weather cache for upcoming fire times in the background
+    def _start_prefetch(self, now):
+        upcoming = self.pop_prefetch(now)
+        if not upcoming:
+            return
+
+        deadline = min(fire_time for _, fire_time in upcoming) - PREFETCH_MARGIN
+        task = asyncio.ensure_future(self.prefetch([user_id for user_id, _ in upcoming], deadline))
+        self.prefetch_tasks.add(task)
+        task.add_done_callback(self._prefetch_done)
+
+    def _prefetch_done(self, task):
+        self.prefetch_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.metrics.record_failure('prefetch_error', task.exception())
+
+    async def _fire_due(self, now):
+        tick_start = time.monotonic()
+        popped = self.pop_due(now)
+        for user_id, fire_time in popped:
+            # Caught-up fire times are in the past, so schedule the next one from now
+            try:
+                self.schedule(user_id, after=max(fire_time, now))
+            except (KeyError, ValueError, pytz.UnknownTimeZoneError) as e:
+                self.fire_times.pop(user_id, None)
+                self.metrics.record_failure('invalid_settings', f'user {user_id}: {e!r}')
+
+        # A lease can lapse between ticks, so check ownership again right before sending
+        due = [(user_id, fire_time) for user_id, fire_time in popped
+               if not self._already_sent(user_id, fire_time) and (self.owns is None or self.owns(user_id))]
+        if due:
+            if self.ledger is not None:
+                await self.ledger.record(due)
+            try:
+                await self.send_updates(due)
+            except Exception as e:
+                self.metrics.record_failure('tick_error', f'{len(due)} users: {e}')
+
+        if popped and self.save is not None:
+            self.save([user_id for user_id, _ in popped])
+
+        if popped:
+            self.metrics.record_tick(time.monotonic() - tick_start, len(popped), len(self.fire_times))
+
+#endregion
+#region Checks
+
+# Function to check DST handling and that dates come from the user's timezone, raises AssertionError on a mismatch
+def check_fire_times():
+    def local(timezone, *wall_time):
+        return localize_wall_time(pytz.timezone(timezone), datetime.datetime(*wall_time)).isoformat()
+
+    def utc_epoch(*wall_time):
+        return int(datetime.datetime(*wall_time, tzinfo=datetime.timezone.utc).timestamp())
+
+    cases = [
+        # Spring-forward: 02:00-03:00 doesn't exist, a time in the gap fires when it ends
+        ('spring-forward gap', local('America/New_York', 2026, 3, 8, 2, 30), '2026-03-08T03:00:00-04:00'),
+        ('day after spring-forward', local('America/New_York', 2026, 3, 9, 2, 30), '2026-03-09T02:30:00-04:00'),
+        # Fall-back: 01:00-02:00 happens twice, the first one (still daylight time) fires
+        ('fall-back repeat', local('America/New_York', 2026, 11, 1, 1, 30), '2026-11-01T01:30:00-04:00'),
+        # Lord Howe moves its clocks by 30 minutes
+        ('30 minute gap', local('Australia/Lord_Howe', 2026, 10, 4, 2, 10), '2026-10-04T02:30:00+11:00'),
+        ('30 minute repeat', local('Australia/Lord_Howe', 2026, 4, 5, 1, 45), '2026-04-05T01:45:00+11:00'),
+        # 23:30 UTC on Jan 1 is already 08:30 on Jan 2 in Tokyo, so 08:00 next fires on Jan 3
+        ('user date ahead of UTC', next_fire_time('08:00', 'Asia/Tokyo', utc_epoch(2026, 1, 1, 23, 30)), utc_epoch(2026, 1, 2, 23, 0)),
+        # 03:00 UTC on Jan 2 is still 19:00 on Jan 1 in Los Angeles, so 20:00 fires the same evening
+        ('user date behind UTC', next_fire_time('20:00', 'America/Los_Angeles', utc_epoch(2026, 1, 2, 3, 0)), utc_epoch(2026, 1, 2, 4, 0)),
+    ]
+    for name, actual, expected in cases:
+        assert actual == expected, f'{name}: expected {expected}, got {actual}'
+        print(f'{name}: {actual} ok')
+
+# Function to check that the sent ledger survives a torn last line: loading skips only that line,
+# and the next batch starts on a fresh line so it is never glued to the torn bytes
+def check_ledger_recovery():
+    import tempfile
+
+    async def check(path):
+        ledger = SentLedger(path)
+        await ledger.record([('1', 100), ('2', 200)])
+        await ledger.record([('1', 300)])
+        with open(path, 'a') as file:
+            file.write('{"3": 40')  # a crash mid-append
+
+        ledger = SentLedger(path)
+        assert ledger.entries == {'1': 300, '2': 200}, f'after a torn line: {ledger.entries}'
+        await ledger.record([('3', 400)])
+        assert SentLedger(path).entries == {'1': 300, '2': 200, '3': 400}, 'a batch after a torn line was lost'
+
+        ledger.save(ledger.entries)
+        assert SentLedger(path).entries == {'1': 300, '2': 200, '3': 400}, 'compaction lost entries'
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(check(os.path.join(directory, 'ledger.json')))
+    print('sent ledger torn-line recovery: ok')
+
+if __name__ == '__main__':
+    check_fire_times()
+    check_ledger_recovery()
+
+#endregion
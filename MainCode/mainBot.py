@@ -19,14 +19,24 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import discord
 from discord import app_commands
 from discord.ui import Select, View
-from discord.ext import tasks, commands
+from discord.ext import commands
 import pytz
 from pytz import all_timezones
-import requests
 import datetime
 from dotenv import load_dotenv
 import os
-import json
+import socket
+import sqlite3
+import asyncio
+import time
+from owmCache import normalize_location
+from owmClient import OWMClient
+from owmQuota import PRIORITY_PREFETCH, PRIORITY_SCHEDULED
+from dailyScheduler import DailyUpdateScheduler, SentLedger
+from schedulerMetrics import SchedulerMetrics, start_metrics_server
+from schedulerShards import ShardCoordinator
+from userSettings import UserSettings, compact_user_data
+from userStore import JSONUserStore, JournalUserStore, SQLiteUserStore, WriteBehindPersister
 
 #endregion
 #region Variables
@@ -37,6 +47,40 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Define the path to the data file
 DATA_FILE = os.path.join(BASE_DIR, '../Server/user_data.json')
 
+# Where user settings are kept: 'json' (DATA_FILE), 'journal' (DATA_FILE as a snapshot plus USER_JOURNAL_FILE)
+# or 'sqlite' (USER_DB_FILE, imported from DATA_FILE on first use)
+USER_STORE = os.getenv('USER_STORE', 'json').lower()
+USER_DB_FILE = os.path.join(BASE_DIR, '../Server/user_data.db')
+USER_JOURNAL_FILE = os.path.join(BASE_DIR, '../Server/user_data.journal')
+
+# Journal size (bytes) after which it is folded into a fresh snapshot
+USER_JOURNAL_COMPACT_BYTES = int(os.getenv('USER_JOURNAL_COMPACT_BYTES', '1048576'))
+
+# How many previous versions of the JSON snapshot are kept as user_data.json.1, .2, ... to fall back to
+USER_SNAPSHOT_BACKUPS = int(os.getenv('USER_SNAPSHOT_BACKUPS', '3'))
+
+# How often (seconds) changed user settings are written out, changes in between are batched together
+USER_SAVE_INTERVAL = float(os.getenv('USER_SAVE_INTERVAL', '2'))
+
+# Daily update scheduler mode: 'local' runs it in the bot process, 'off' leaves it to separate
+# 'worker' processes (started with SCHEDULER_MODE=worker) that each own a slice of the subscribers
+SCHEDULER_MODE = os.getenv('SCHEDULER_MODE', 'local').lower()
+SCHEDULER_WORKER_ID = os.getenv('SCHEDULER_WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')
+SHARD_SLICE_COUNT = int(os.getenv('SHARD_SLICE_COUNT', '64'))
+SHARD_LEASE_TTL = int(os.getenv('SHARD_LEASE_TTL', '30'))
+
+# Define the path to the daily update sent ledger, every worker keeps its own
+LEDGER_FILE = os.path.join(BASE_DIR, '../Server/daily_update_ledger.json')
+if SCHEDULER_MODE == 'worker':
+    LEDGER_FILE = os.path.join(BASE_DIR, f'../Server/daily_update_ledger.{SCHEDULER_WORKER_ID}.json')
+LEDGER_PEER_PATTERN = os.path.join(BASE_DIR, '../Server/daily_update_ledger*.json')
+
+# Define the path to the scheduler worker lease database
+SHARD_LEASE_FILE = os.path.join(BASE_DIR, '../Server/scheduler_leases.db')
+
+# Define the path to the geocoding cache file
+GEOCODE_CACHE_FILE = os.path.join(BASE_DIR, '../Server/geocode_cache.json')
+
 authorized_user_id = 971538245320081508
 
 # Load environment variables from .env file
@@ -45,12 +89,94 @@ load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 OPENWEATHERMAP_API_KEY = os.getenv('OPENWEATHERMAP_API_KEY')
 
+# Connection pool settings for OpenWeatherMap requests
+OWM_MAX_CONNECTIONS = int(os.getenv('OWM_MAX_CONNECTIONS', '100'))
+OWM_MAX_CONNECTIONS_PER_HOST = int(os.getenv('OWM_MAX_CONNECTIONS_PER_HOST', '20'))
+OWM_DNS_CACHE_TTL = int(os.getenv('OWM_DNS_CACHE_TTL', '300'))
+OWM_KEEPALIVE_TIMEOUT = int(os.getenv('OWM_KEEPALIVE_TIMEOUT', '30'))
+
+# Current weather cache settings (seconds / number of locations)
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', '600'))
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', '1000'))
+
+# OpenWeatherMap API key budget (0 calls per day means no daily limit)
+OWM_CALLS_PER_MINUTE = int(os.getenv('OWM_CALLS_PER_MINUTE', '60'))
+OWM_CALLS_PER_DAY = int(os.getenv('OWM_CALLS_PER_DAY', '0'))
+
+# Forecast / air pollution cache lifetimes, and how long expired entries may still be served while refreshing
+FORECAST_CACHE_TTL = int(os.getenv('FORECAST_CACHE_TTL', '1800'))
+AIR_POLLUTION_CACHE_TTL = int(os.getenv('AIR_POLLUTION_CACHE_TTL', '1800'))
+STALE_GRACE_PERIOD = int(os.getenv('STALE_GRACE_PERIOD', '300'))
+
+# OpenWeatherMap timeouts (seconds), retries, and circuit breaker settings
+OWM_CONNECT_TIMEOUT = float(os.getenv('OWM_CONNECT_TIMEOUT', '3'))
+OWM_READ_TIMEOUT = float(os.getenv('OWM_READ_TIMEOUT', '5'))
+OWM_FORECAST_READ_TIMEOUT = float(os.getenv('OWM_FORECAST_READ_TIMEOUT', '10'))
+OWM_MAX_RETRIES = int(os.getenv('OWM_MAX_RETRIES', '2'))
+OWM_BREAKER_THRESHOLD = int(os.getenv('OWM_BREAKER_THRESHOLD', '5'))
+OWM_BREAKER_RESET = int(os.getenv('OWM_BREAKER_RESET', '30'))
+
+# How long after a missed daily update (seconds) it is still sent once the bot comes back online
+DAILY_UPDATE_CATCHUP_WINDOW = int(os.getenv('DAILY_UPDATE_CATCHUP_WINDOW', '3600'))
+
+# How far ahead (seconds) weather is prefetched for upcoming daily updates, keep this below WEATHER_CACHE_TTL
+DAILY_UPDATE_PREFETCH_LEAD = int(os.getenv('DAILY_UPDATE_PREFETCH_LEAD', '300'))
+
+# Spread daily updates up to this many seconds either side of the chosen time (0 disables smoothing).
+# Each user always gets the same offset, so their update still arrives at a stable time every day.
+DAILY_UPDATE_SMOOTHING_WINDOW = int(os.getenv('DAILY_UPDATE_SMOOTHING_WINDOW', '0'))
+
+# How many daily update DMs may be in flight at once
+DAILY_UPDATE_DM_CONCURRENCY = int(os.getenv('DAILY_UPDATE_DM_CONCURRENCY', '10'))
+
+# Port to serve daily update scheduler metrics on at /metrics in the Prometheus text format (0 disables it)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Grid size (degrees) that coordinates are snapped to for cache keys, 0.05° is roughly 5 km
+LOCATION_GRID_SIZE = float(os.getenv('LOCATION_GRID_SIZE', '0.05'))
+
+# Async OpenWeatherMap client shared by every command, its pooled session is opened in on_ready
+owm = OWMClient(
+    OPENWEATHERMAP_API_KEY,
+    max_connections=OWM_MAX_CONNECTIONS,
+    max_connections_per_host=OWM_MAX_CONNECTIONS_PER_HOST,
+    dns_cache_ttl=OWM_DNS_CACHE_TTL,
+    keepalive_timeout=OWM_KEEPALIVE_TIMEOUT,
+    weather_cache_ttl=WEATHER_CACHE_TTL,
+    weather_cache_size=WEATHER_CACHE_SIZE,
+    geocode_cache_file=GEOCODE_CACHE_FILE,
+    calls_per_minute=OWM_CALLS_PER_MINUTE,
+    calls_per_day=OWM_CALLS_PER_DAY,
+    forecast_cache_ttl=FORECAST_CACHE_TTL,
+    air_pollution_cache_ttl=AIR_POLLUTION_CACHE_TTL,
+    stale_grace=STALE_GRACE_PERIOD,
+    connect_timeout=OWM_CONNECT_TIMEOUT,
+    read_timeout=OWM_READ_TIMEOUT,
+    slow_read_timeout=OWM_FORECAST_READ_TIMEOUT,
+    max_retries=OWM_MAX_RETRIES,
+    breaker_threshold=OWM_BREAKER_THRESHOLD,
+    breaker_reset=OWM_BREAKER_RESET,
+    grid_size=LOCATION_GRID_SIZE,
+)
+
 
 # Create an instance of Intents
 intents = discord.Intents.default()
 
+# Bot subclass that stops the scheduler and closes the shared OpenWeatherMap session on shutdown
+class WeatherBot(commands.Bot):
+    async def close(self):
+        scheduler.stop()
+        persister.stop()
+        await persister.flush()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await owm.close()
+        await super().close()
+
 # Create an instance of the bot
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = WeatherBot(command_prefix="!", intents=intents)
 
 # Dictionary to store user default locations (user_id: location)
 default_locations = {}
@@ -72,12 +198,28 @@ PM2_5_RANGES = [(0, 10), (10, 25), (25, 50), (50, 75), (75, float('inf'))]
 O3_RANGES = [(0, 60), (60, 100), (100, 140), (140, 180), (180, float('inf'))]
 CO_RANGES = [(0, 4400), (4400, 9400), (9400, 12400), (12400, 15400), (15400, float('inf'))]
 
+# Daily update counters, shows how many recipients share each location fetch
+daily_update_stats = {
+    'ticks': 0,
+    'recipients': 0,
+    'unique_locations': 0,
+    'last_tick_recipients': 0,
+    'last_tick_unique_locations': 0,
+    'last_fan_out_seconds': 0.0,
+    'max_fan_out_seconds': 0.0,
+}
+
+# Daily update scheduler lateness, tick times, backlog and failures by cause
+scheduler_metrics = SchedulerMetrics()
+metrics_runner = None
+
+# DM channel ids learned by a scheduler worker. Workers can't save them to the user store,
+# so they are kept here and put back after every reload of the user data.
+learned_dm_channels = {}
+
 # Generate a list of all available time zones from pytz
 timezones_list = pytz.all_timezones
 
-# Set to track users who have received the update in the current minute
-sent_updates = set()
-
 #endregion
 #region Helper Functions
 
@@ -106,24 +248,49 @@ def get_qualitative_name(index):
     names = [":green_circle: Good", ":orange_circle: Fair", ":yellow_circle: Moderate", ":red_circle: Poor", " :purple_circle: Very Poor"]
     return names[index - 1]
 
+# ------------------------- Cache Functions -------------------------
+
+# Function to build a note for responses served from a stale cache entry.
+# Messages nobody will follow up on (daily updates) leave out the promise of fresh data.
+def stale_note(payload, refreshing=True):
+    cached_at = payload.get('cached_at') if isinstance(payload, dict) else payload.cached_at
+    if cached_at is None:
+        return ''
+    if not refreshing:
+        return f'\n*Cached at <t:{int(cached_at)}:t>.*'
+    return f'\n*Cached at <t:{int(cached_at)}:t>, fresh data is on its way.*'
+
 # ------------------------- Data Storage Functions -------------------------
 
+if USER_STORE == 'sqlite':
+    # Workers only read, the bot process does the one-time import
+    user_store = SQLiteUserStore(USER_DB_FILE, import_from=DATA_FILE if SCHEDULER_MODE != 'worker' else None)
+elif USER_STORE == 'journal':
+    user_store = JournalUserStore(DATA_FILE, USER_JOURNAL_FILE, compact_threshold=USER_JOURNAL_COMPACT_BYTES,
+                                  backups=USER_SNAPSHOT_BACKUPS, read_only=SCHEDULER_MODE == 'worker')
+else:
+    user_store = JSONUserStore(DATA_FILE, backups=USER_SNAPSHOT_BACKUPS, read_only=SCHEDULER_MODE == 'worker')
+
 def read_data():
-    try:
-        with open(DATA_FILE, 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return {}
-    except json.JSONDecodeError:
-        return {}
+    return compact_user_data(user_store.load())
+
 
+async def write_data(data):
+    await persister.save_all(data)
 
-def write_data(data):
-    with open(DATA_FILE, 'w') as file:
-        json.dump(data, file, indent=4)
+# Function to queue a single user's settings to be saved after a handler changes them
+def save_user(user_id):
+    persister.mark_dirty(user_id)
+
+# Function to queue the users the scheduler rescheduled to be saved
+def save_users(user_ids):
+    for user_id in user_ids:
+        persister.mark_dirty(user_id)
 
 # Global data storage
 data = read_data()
+print(f"Loaded {len(data)} users from {user_store.loaded_from} in {user_store.load_seconds * 1000:.1f} ms")
+persister = WriteBehindPersister(user_store, lambda: data, interval=USER_SAVE_INTERVAL)
 
 # ------------------------- Date / Time Functions -------------------------
 
@@ -221,23 +388,15 @@ async def get_weather(ctx: discord.Interaction, *, location: str = None):
             await ctx.followup.send(embed=embed)
         return
 
-    weather_api_url = f'http://api.openweathermap.org/data/2.5/weather?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-    response = requests.get(weather_api_url)
-    weather_data = response.json()
-
-    if response.status_code == 200:
-        main_weather = weather_data['weather'][0]['main']
-        description = weather_data['weather'][0]['description']
-        temperature_main = weather_data['main']['temp']
-        temperature = temperature_main - 273.15
+    status, weather = await owm.current_weather(location)
 
-        if default_unit == 'F':
-            temperature = (temperature_main - 273.15) * 9/5 + 32
+    if status == 200:
+        temperature = weather.format_temperature(default_unit)
 
         if format_preference.lower() == 'plain':
-            await ctx.followup.send(f'The weather in {location} is {main_weather} ({description}) with a temperature of {temperature:.2f}°{"F" if default_unit == "F" else "C"}.')
+            await ctx.followup.send(f'The weather in {location} is {weather.main} ({weather.description}) with a temperature of {temperature}.{stale_note(weather)}')
         else:
-            embed = discord.Embed(title=f"Weather in {location}", description=f"{main_weather} ({description}) with a temperature of {temperature:.2f}°{'F' if default_unit == 'F' else 'C'}", color=0x66b4ff)
+            embed = discord.Embed(title=f"Weather in {location}", description=f"{weather.main} ({weather.description}) with a temperature of {temperature}{stale_note(weather)}", color=0x66b4ff)
             await ctx.followup.send(embed=embed)
     else:
         error_message = f"Unable to fetch weather for {location}. Please check the location and try again."
@@ -268,11 +427,9 @@ async def get_forecast(ctx: discord.Interaction, *, location: str = None):
             return
 
     # Call OpenWeatherMap Geocoding API
-    geocoding_api_url = f'http://api.openweathermap.org/geo/1.0/direct?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-    geocoding_response = requests.get(geocoding_api_url)
-    geocoding_data = geocoding_response.json()
+    geocoding_status, geocoding_data = await owm.geocode(location)
 
-    if geocoding_response.status_code != 200 or not geocoding_data:
+    if geocoding_status != 200 or not geocoding_data:
         error_message = f"Unable to fetch coordinates for {location}. Please check the location and try again."
         if format_preference.lower() == 'plain':
             await ctx.followup.send(error_message)
@@ -284,14 +441,12 @@ async def get_forecast(ctx: discord.Interaction, *, location: str = None):
     lat = geocoding_data[0]['lat']
     lon = geocoding_data[0]['lon']
 
-    forecast_api_url = f'http://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={OPENWEATHERMAP_API_KEY}'
-    response = requests.get(forecast_api_url)
-    forecast_data = response.json()
+    status, forecast_data = await owm.forecast(lat, lon)
 
-    if response.status_code == 200:
+    if status == 200:
         forecast_list = forecast_data['list']
         view = DateSelectView(forecast_list, location)
-        await ctx.followup.send("Select a date to view the weather forecast:", view=view)
+        await ctx.followup.send(f"Select a date to view the weather forecast:{stale_note(forecast_data)}", view=view)
     else:
         error_message = f"Unable to fetch weather forecast for {location}. Please check the location and try again."
         if format_preference.lower() == 'plain':
@@ -300,18 +455,12 @@ async def get_forecast(ctx: discord.Interaction, *, location: str = None):
             embed = discord.Embed(title="Forecast error", description=error_message, color=0xFF0000)
             await ctx.followup.send(embed=embed)
 
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f)
-
 # Command to get a 16-day forecast
 @bot.tree.command(name="16dayforecast", description="Get a 16-day forecast without ")
 async def get_forecast16(ctx: discord.Interaction, *, location: str = None):
         await ctx.response.defer()
 
         user_id = str(ctx.user.id)
-        with open(DATA_FILE, 'r') as f:
-            data = json.load(f)
-        
         user_data = data.get(user_id, {})
         format_preference = user_data.get('format', 'embed')
 
@@ -327,11 +476,9 @@ async def get_forecast16(ctx: discord.Interaction, *, location: str = None):
                 return
 
         # Call OpenWeatherMap Geocoding API
-        geocoding_api_url = f'http://api.openweathermap.org/geo/1.0/direct?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-        geocoding_response = requests.get(geocoding_api_url)
-        geocoding_data = geocoding_response.json()
+        geocoding_status, geocoding_data = await owm.geocode(location)
 
-        if geocoding_response.status_code != 200 or not geocoding_data:
+        if geocoding_status != 200 or not geocoding_data:
             error_message = f"Unable to fetch coordinates for {location}. Please check the location and try again."
             if format_preference.lower() == 'plain':
                 await ctx.followup.send(error_message)
@@ -343,13 +490,10 @@ async def get_forecast16(ctx: discord.Interaction, *, location: str = None):
         lat = geocoding_data[0]['lat']
         lon = geocoding_data[0]['lon']
 
-        forecast_api_url = f'http://api.openweathermap.org/data/2.5/forecast/daily?lat={lat}&lon={lon}&cnt=16&appid={OPENWEATHERMAP_API_KEY}'
-
-        response = requests.get(forecast_api_url)
-        forecast_data = response.json()
+        status, forecast_data = await owm.daily_forecast(lat, lon)
 
         # Check if the API request was successful
-        if response.status_code == 200:
+        if status == 200:
             # Extract the forecast data
             forecast_list = forecast_data['list']
 
@@ -366,10 +510,10 @@ async def get_forecast16(ctx: discord.Interaction, *, location: str = None):
                         temperature = (temperature * 9/5) + 32
 
                     forecast_message += f'{forecast_date}: Temp: {temperature:.2f}°{"F" if user_data.get("unit") == "F" else "C"}, Weather: {description}\n'
-                await ctx.followup.send(forecast_message)
+                await ctx.followup.send(forecast_message + stale_note(forecast_data))
             else:
                 view = DateSelectView16(forecast_list, location)
-                await ctx.followup.send("Select a date to view the weather forecast:", view=view)
+                await ctx.followup.send(f"Select a date to view the weather forecast:{stale_note(forecast_data)}", view=view)
         else:
             error_message = f"Unable to fetch weather forecast for {location}. Please check the location and try again."
             if format_preference.lower() == 'plain':
@@ -378,10 +522,6 @@ async def get_forecast16(ctx: discord.Interaction, *, location: str = None):
                 embed = discord.Embed(title="Forecast error", description=error_message, color=0xFF0000)
                 await ctx.followup.send(embed=embed)
 
-        # Save the user data to the file
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f)
-
 # Command to get air quality for a location
 @bot.tree.command(name="airquality", description="Get the air quality for a location")
 async def get_air_quality(ctx: discord.Interaction, *, location: str = None, details: bool = False):
@@ -403,11 +543,9 @@ async def get_air_quality(ctx: discord.Interaction, *, location: str = None, det
             return
     
     # Call OpenWeatherMap Geocoding API
-    geocoding_api_url = f'http://api.openweathermap.org/geo/1.0/direct?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-    geocoding_response = requests.get(geocoding_api_url)
-    geocoding_data = geocoding_response.json()
+    geocoding_status, geocoding_data = await owm.geocode(location)
 
-    if geocoding_response.status_code != 200 or not geocoding_data:
+    if geocoding_status != 200 or not geocoding_data:
         error_message = f"Unable to fetch coordinates for {location}. Please check the location and try again."
         if format_preference.lower() == 'plain':
             await ctx.followup.send(error_message)
@@ -419,13 +557,10 @@ async def get_air_quality(ctx: discord.Interaction, *, location: str = None, det
     lat = geocoding_data[0]['lat']
     lon = geocoding_data[0]['lon']
 
-    air_quality_api_url = f'http://api.openweathermap.org/data/2.5/air_pollution?lat={lat}&lon={lon}&appid={OPENWEATHERMAP_API_KEY}'
-
-    response = requests.get(air_quality_api_url)
-    air_quality_data = response.json()
+    status, air_quality_data = await owm.air_pollution(lat, lon)
 
     # Check if the API request was successful
-    if response.status_code == 200:
+    if status == 200:
         so2 = air_quality_data['list'][0]['components']['so2']
         no2 = air_quality_data['list'][0]['components']['no2']
         pm10 = air_quality_data['list'][0]['components']['pm10']
@@ -450,6 +585,7 @@ async def get_air_quality(ctx: discord.Interaction, *, location: str = None, det
             air_quality_message = (
                 f"Air Quality Index: **{air_quality_index}** | {qualitative_name}"
             )
+        air_quality_message += stale_note(air_quality_data)
         
         if format_preference.lower() == 'plain':
             await ctx.followup.send(air_quality_message)
@@ -464,10 +600,6 @@ async def get_air_quality(ctx: discord.Interaction, *, location: str = None, det
             embed = discord.Embed(title="Forecast error", description=error_message, color=0xFF0000)
             await ctx.followup.send(embed=embed)
 
-    # Save the user data to the file
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f)
-
 # Command to get the wind information
 @bot.tree.command(name="wind", description="Get the wind information for a location")
 async def get_wind(ctx: discord.Interaction, *, location: str = None):
@@ -488,18 +620,16 @@ async def get_wind(ctx: discord.Interaction, *, location: str = None):
                 await ctx.followup.send(embed=embed)
             return
 
-    weather_api_url = f'http://api.openweathermap.org/data/2.5/weather?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-    response = requests.get(weather_api_url)
-    weather_data = response.json()
+    status, weather = await owm.current_weather(location)
 
-    if response.status_code == 200:
-        wind_speed = weather_data['wind']['speed']
-        wind_direction = weather_data['wind']['deg']
+    if status == 200:
+        wind_speed = weather.wind_speed
+        wind_direction = weather.wind_deg
 
         if format_preference.lower() == 'plain':
-            await ctx.followup.send(f'The wind in {location} is blowing at {wind_speed} m/s in the direction of {wind_direction}°.')
+            await ctx.followup.send(f'The wind in {location} is blowing at {wind_speed} m/s in the direction of {wind_direction}°.{stale_note(weather)}')
         else:
-            embed = discord.Embed(title="Wind", description=f'The wind in {location} is blowing at {wind_speed} m/s in the direction of {wind_direction}°.', color=0x8fd0d6)
+            embed = discord.Embed(title="Wind", description=f'The wind in {location} is blowing at {wind_speed} m/s in the direction of {wind_direction}°.{stale_note(weather)}', color=0x8fd0d6)
             await ctx.followup.send(embed=embed)
     else:
         if format_preference.lower() == 'plain':
@@ -528,17 +658,15 @@ async def get_humidity(ctx: discord.Interaction, *, location: str = None):
                 await ctx.followup.send(embed=embed)
             return
 
-    weather_api_url = f'http://api.openweathermap.org/data/2.5/weather?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-    response = requests.get(weather_api_url)
-    weather_data = response.json()
+    status, weather = await owm.current_weather(location)
 
-    if response.status_code == 200:
-        humidity = weather_data['main']['humidity']
+    if status == 200:
+        humidity = weather.humidity
 
         if format_preference.lower() == 'plain':
-            await ctx.followup.send(f'The humidity in {location} is {humidity}%.')
+            await ctx.followup.send(f'The humidity in {location} is {humidity}%.{stale_note(weather)}')
         else:
-            embed = discord.Embed(title="Humidity", description=f'The humidity in {location} is {humidity}%.', color=0x7368d8)
+            embed = discord.Embed(title="Humidity", description=f'The humidity in {location} is {humidity}%.{stale_note(weather)}', color=0x7368d8)
             await ctx.followup.send(embed=embed)
     else:
         if format_preference.lower() == 'plain':
@@ -567,18 +695,16 @@ async def get_sun_times(ctx: discord.Interaction, *, location: str = None):
             return
 
     # Call OpenWeatherMap API
-    weather_api_url = f'http://api.openweathermap.org/data/2.5/weather?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-    response = requests.get(weather_api_url)
-    weather_data = response.json()
+    status, weather = await owm.current_weather(location)
 
     # Check if the API request was successful
-    if response.status_code == 200:
+    if status == 200:
         # Extract sunrise and sunset times
-        sunrise_timestamp = weather_data['sys']['sunrise']
-        sunset_timestamp = weather_data['sys']['sunset']
+        sunrise_timestamp = weather.sunrise
+        sunset_timestamp = weather.sunset
 
         # Convert timestamps to timezone-aware datetime objects
-        timezone_offset = weather_data['timezone']
+        timezone_offset = weather.timezone_offset
         sunrise_time_utc = datetime.datetime.fromtimestamp(sunrise_timestamp, tz=pytz.utc)
         sunrise_time_local = sunrise_time_utc.astimezone(pytz.timezone(f'Etc/GMT{timezone_offset//3600}'))
         sunset_time_utc = datetime.datetime.fromtimestamp(sunset_timestamp, tz=pytz.utc)
@@ -596,10 +722,10 @@ async def get_sun_times(ctx: discord.Interaction, *, location: str = None):
         # Send the sunrise and sunset times with Discord timestamps to the Discord channel
         if format_preference.lower() == 'plain':
             #send message as a plain text
-            await ctx.followup.send(f'The sunrise in {location} is at {formatted_sunrise_time}, and the sunset is at {formatted_sunset_time}.')
+            await ctx.followup.send(f'The sunrise in {location} is at {formatted_sunrise_time}, and the sunset is at {formatted_sunset_time}.{stale_note(weather)}')
         else:
             #send as embed
-            embed = discord.Embed(title="Sun times", description=f'The sunrise in {location} is {formatted_sunrise_time}, and the sunset is {formatted_sunset_time}.', color=0xf7a751)
+            embed = discord.Embed(title="Sun times", description=f'The sunrise in {location} is {formatted_sunrise_time}, and the sunset is {formatted_sunset_time}.{stale_note(weather)}', color=0xf7a751)
             await ctx.followup.send(embed=embed)    
     else:
         await ctx.followup.send(f"Unable to fetch sunrise and sunset times for {location}. Please check the location and try again.")
@@ -633,16 +759,14 @@ async def get_alerts(ctx: discord.Interaction, *, location: str = None):
             return
 
     # Call OpenWeatherMap API
-    alerts_api_url = f'https://api.openweathermap.org/data/2.5/weather?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-    response = requests.get(alerts_api_url)
-    weather_data = response.json()
+    status, weather = await owm.current_weather(location)
 
     # Check if the API request was successful
-    if response.status_code == 200:
+    if status == 200:
         # Check if there are any weather alerts
-        if 'alerts' in weather_data:
+        if weather.alerts:
             # Extract and display weather alerts
-            alerts = weather_data['alerts']
+            alerts = weather.alerts
             alert_message = f'Weather alerts for {location}:\n'
             for alert in alerts:
                 event = alert['event']
@@ -650,6 +774,7 @@ async def get_alerts(ctx: discord.Interaction, *, location: str = None):
                 start_time = datetime.datetime.utcfromtimestamp(alert['start']).strftime('%Y-%m-%d %H:%M:%S UTC')
                 end_time = datetime.datetime.utcfromtimestamp(alert['end']).strftime('%Y-%m-%d %H:%M:%S UTC')
                 alert_message += f'{event}: {description}\nStart Time: {start_time}\nEnd Time: {end_time}\n\n'
+            alert_message += stale_note(weather)
 
             if format_preference.lower() == 'plain':
                 await ctx.followup.send(alert_message)
@@ -658,9 +783,9 @@ async def get_alerts(ctx: discord.Interaction, *, location: str = None):
                 await ctx.followup.send(embed=embed)
         else:
             if format_preference.lower() == 'plain':
-                await ctx.followup.send(f'No weather alerts for {location}.')
+                await ctx.followup.send(f'No weather alerts for {location}.{stale_note(weather)}')
             else:
-                embed = discord.Embed(title="No Alerts", description=f'No weather alerts for {location}.', color=0xf75451)
+                embed = discord.Embed(title="No Alerts", description=f'No weather alerts for {location}.{stale_note(weather)}', color=0xf75451)
                 await ctx.followup.send(embed=embed)
     else:
         error_message = f"Unable to fetch weather alerts for {location}. Please check the location and try again."
@@ -670,17 +795,13 @@ async def get_alerts(ctx: discord.Interaction, *, location: str = None):
             embed = discord.Embed(title="Alert Error", description=error_message, color=0xFF0000)
             await ctx.followup.send(embed=embed)
 
-    # Save the user data to the file
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f)
-
 # Command to set a daily update time with timezone and AM/PM option
 @bot.tree.command(name="dailyupdate", description="Set a specific time for daily weather updates, choose AM/PM, and select a timezone")
 async def set_daily_update(ctx: discord.Interaction, time: str, am_pm: str, timezone: str):
     await ctx.response.defer()
 
     user_id = str(ctx.user.id)
-    user_data = data.get(user_id, {})
+    user_data = data.get(user_id) or UserSettings()
     format_preference = user_data.get('format', 'embed')
 
     # Parse the time in 12-hour format with AM/PM
@@ -709,7 +830,8 @@ async def set_daily_update(ctx: discord.Interaction, time: str, am_pm: str, time
     user_data['timezone'] = timezone
     user_data['am_pm'] = am_pm.upper()
     data[user_id] = user_data
-    write_data(data)
+    scheduler.schedule(user_id)
+    save_user(user_id)
 
     if format_preference.lower() == 'plain':
         await ctx.followup.send(f'Daily weather update time set to {time} {am_pm.upper()} in {timezone}.')
@@ -738,7 +860,8 @@ async def disable_daily_update(ctx: discord.Interaction):
         del user_data['daily_update_time']
         del user_data['timezone']
         data[user_id] = user_data
-        write_data(data)
+        scheduler.unschedule(user_id)
+        save_user(user_id)
         if format_preference.lower() == 'plain':
             await ctx.followup.send("Daily weather updates have been turned off.")
         else:
@@ -761,10 +884,10 @@ async def set_location(ctx: discord.Interaction, *, location: str):
 
     user_id = str(ctx.user.id)
     if user_id not in data:
-        data[user_id] = {}
+        data[user_id] = UserSettings()
 
     data[user_id]['location'] = location
-    write_data(data)
+    save_user(user_id)
 
     format_preference = data[user_id].get('format', 'embed')
 
@@ -774,6 +897,9 @@ async def set_location(ctx: discord.Interaction, *, location: str):
         embed = discord.Embed(title="Setting location", description=f'Default location set to {location}', color=0x86f751)
         await ctx.followup.send(embed=embed)
 
+    # Warm the geocoding cache so coordinate-based commands only need one request
+    await owm.geocode(location)
+
 # Command to set a default temperature unit
 @bot.tree.command(name="setunit", description="Set a default temperature unit (C or F)")
 async def set_unit(ctx: discord.Interaction, unit: str):
@@ -784,11 +910,11 @@ async def set_unit(ctx: discord.Interaction, unit: str):
     unit = unit.upper()
 
     if user_id not in data:
-        data[user_id] = {}
+        data[user_id] = UserSettings()
 
     if unit in ['C', 'F']:
         data[user_id]['unit'] = unit
-        write_data(data)
+        save_user(user_id)
 
         if format_preference.lower() == 'plain':
             await ctx.followup.send(f'Default temperature unit set to {unit}.')
@@ -799,7 +925,7 @@ async def set_unit(ctx: discord.Interaction, unit: str):
     elif unit == "🦅":
 
         data[user_id]['unit'] = 'F'
-        write_data(data)
+        save_user(user_id)
 
         if format_preference.lower() == 'plain':
             await ctx.followup.send(f'Default temperature unit set to Freedom Units.')
@@ -810,7 +936,7 @@ async def set_unit(ctx: discord.Interaction, unit: str):
     elif unit == "🍁":
 
         data[user_id]['unit'] = 'C'
-        write_data(data)
+        save_user(user_id)
 
         if format_preference.lower() == 'plain':
             await ctx.followup.send(f'Default temperature unit set to Logical.')
@@ -821,7 +947,7 @@ async def set_unit(ctx: discord.Interaction, unit: str):
     elif unit.lower() == "freedom" :
 
         data[user_id]['unit'] = 'F'
-        write_data(data)
+        save_user(user_id)
 
         if format_preference.lower() == 'plain':
             await ctx.followup.send(f'Default temperature unit set to Freedom Units.')
@@ -832,7 +958,7 @@ async def set_unit(ctx: discord.Interaction, unit: str):
     elif unit.lower() == "logical" :
 
         data[user_id]['unit'] = 'C'
-        write_data(data)
+        save_user(user_id)
 
         if format_preference.lower() == 'plain':
             await ctx.followup.send(f'Default temperature unit set to Logical.')
@@ -854,12 +980,10 @@ async def format_message(ctx: discord.Interaction, message_format: str):
 
     if message_format.lower() in ['embed', 'plain']:
         user_id = str(ctx.user.id)
-        data.setdefault(user_id, {})
+        data.setdefault(user_id, UserSettings())
         data[user_id]['format'] = message_format.lower()
 
-        # Save the user data to the file
-        with open('user_data.json', 'w') as f:
-            json.dump(data, f)
+        save_user(user_id)
 
         await ctx.followup.send(f'Message format preference set to {message_format.lower()}.')
     else:
@@ -985,84 +1109,250 @@ async def smiley_command(ctx:discord.Interaction):
 async def update_bot(ctx: discord.Interaction):
     await ctx.response.defer()
 
+    global data
     user_id = str(ctx.user.id)
     if user_id == str(authorized_user_id):
-        try:
-            with open(DATA_FILE, 'r') as file:
-                global data
-                data = json.load(file)
-                await ctx.followup.send("Bot data updated successfully from JSON.")
-        except FileNotFoundError:
-            await ctx.followup.send("JSON file not found.")
-        except json.JSONDecodeError:
-            await ctx.followup.send("Error decoding JSON... Creating empty dictionary")
-            data = {}
-            await ctx.channel.send("Data = \{\}")
+        # Write out pending changes first, or reloading would throw them away
+        await persister.flush()
+        # Reload from the store itself, with SQLite user_data.json is only the pre-migration copy.
+        # Damaged files fall back to the newest good backup, the current data is kept if there is none
+        loaded = read_data()
+        loaded_from = user_store.loaded_from
+        if loaded_from is None and not loaded:
+            await ctx.followup.send("No readable JSON file found, keeping the current data.")
+            return
+
+        data = loaded
+        scheduler.load(data)
+        if USER_STORE == 'journal':
+            await ctx.followup.send(f"Bot data updated successfully from {loaded_from} and {user_store.replayed} journal records.")
+        else:
+            await ctx.followup.send(f"Bot data updated successfully from {loaded_from}.")
+    else:
+        await ctx.followup.send("You are not authorized to use this command.")
+
+@bot.tree.command(name="botstats", description="Show internal bot statistics")
+async def bot_stats(ctx: discord.Interaction):
+    await ctx.response.defer()
+
+    user_id = str(ctx.user.id)
+    if user_id == str(authorized_user_id):
+        owm_stats = owm.stats()
+        geocode_cache_stats = owm.geocode_cache.stats()
+        quota_stats = owm.quota.stats()
+        breaker_stats = owm.breaker.stats()
+        burst_report = scheduler.burst_report()
+        storage_stats = persister.stats()
+
+        lines = [
+            "**OpenWeatherMap connections**",
+            f"Requests sent: {owm_stats['requests_sent']}",
+            f"Connections created: {owm_stats['connections_created']}",
+            f"Connections reused: {owm_stats['connections_reused']}",
+            f"Reuse rate: {owm_stats['connection_reuse_rate']:.1%}",
+            f"Requests coalesced: {owm_stats['requests_coalesced']}",
+            f"Background refreshes: {owm_stats['revalidations']}",
+            f"Retries: {owm_stats['retries']} | Timeouts: {owm_stats['timeouts']}",
+            f"Circuit breaker: {breaker_stats['state']} ({breaker_stats['consecutive_failures']} consecutive failures, "
+            f"opened {breaker_stats['times_opened']} times, {breaker_stats['short_circuited']} requests shed)",
+            "",
+            "**Response caches**",
+        ]
+        for name, cache in (('Weather', owm.weather_cache), ('Forecast', owm.forecast_cache), ('Air pollution', owm.air_pollution_cache)):
+            cache_stats = cache.stats()
+            lines.append(f"{name}: {cache_stats['entries']} entries, {cache_stats['hits']} hits, {cache_stats['stale_hits']} stale, "
+                         f"{cache_stats['misses']} misses ({cache_stats['hit_rate']:.1%}, "
+                         f"{cache_stats['unmerged_hit_rate']:.1%} without grid merging)")
+        lines += [
+            "",
+            "**Geocoding cache**",
+            f"Entries: {geocode_cache_stats['entries']}",
+            f"Hits: {geocode_cache_stats['hits']} | Misses: {geocode_cache_stats['misses']}",
+            "",
+            "**API quota**",
+            f"Calls today: {quota_stats['calls_today']}",
+            f"Waiting: {quota_stats['waiting']} | Rejected: {quota_stats['rejected']} | Priority raised: {quota_stats['raised']}",
+            f"Granted: {', '.join(f'{name} {count}' for name, count in quota_stats['granted'].items())}",
+            f"Queued: {', '.join(f'{name} {count}' for name, count in quota_stats['queued'].items())}",
+            "",
+            "**Daily updates**",
+            f"Subscribers: {len(scheduler.fire_times)}",
+            f"Missed updates caught up on startup: {scheduler.caught_up}",
+            f"Ticks: {daily_update_stats['ticks']}",
+            f"Recipients: {daily_update_stats['recipients']} from {daily_update_stats['unique_locations']} location fetches",
+            f"Last tick: {daily_update_stats['last_tick_recipients']} recipients, {daily_update_stats['last_tick_unique_locations']} unique locations",
+            f"DM fan-out: last {daily_update_stats['last_fan_out_seconds']:.2f}s, max {daily_update_stats['max_fan_out_seconds']:.2f}s "
+            f"(concurrency {DAILY_UPDATE_DM_CONCURRENCY})",
+            f"Smoothing window: ±{DAILY_UPDATE_SMOOTHING_WINDOW}s",
+            f"Largest burst per minute: {burst_report['largest_before']} unsmoothed, {burst_report['largest_after']} smoothed",
+            f"Burst sizes unsmoothed: {', '.join(f'{size}: {count}' for size, count in burst_report['before'].items()) or 'none'}",
+            f"Burst sizes smoothed: {', '.join(f'{size}: {count}' for size, count in burst_report['after'].items()) or 'none'}",
+            "",
+            "**User data storage**",
+            f"Store: {USER_STORE} | Save interval: {USER_SAVE_INTERVAL:g}s | Pending: {storage_stats['pending']}",
+            f"Last load: {len(data)} users from {user_store.loaded_from} in {user_store.load_seconds * 1000:.1f} ms",
+            f"Changes: {storage_stats['marked']} batched into {storage_stats['flushes']} writes ({storage_stats['users_written']} users)",
+            f"Bytes written: {storage_stats['bytes_this_hour']} this hour, {storage_stats['bytes_last_hour']} last hour, {storage_stats['bytes_written']} total",
+        ]
+        if USER_STORE == 'journal':
+            lines.append(f"Journal: {user_store.journal_size} bytes (compacts at {USER_JOURNAL_COMPACT_BYTES}), "
+                         f"{user_store.replayed} records replayed on load, {user_store.compactions} compactions")
+        stats_message = '\n'.join(lines)
+        await ctx.followup.send(stats_message)
+    else:
+        await ctx.followup.send("You are not authorized to use this command.")
+
+@bot.tree.command(name="schedulerstats", description="Show daily update scheduler metrics")
+async def scheduler_stats(ctx: discord.Interaction):
+    await ctx.response.defer()
+
+    user_id = str(ctx.user.id)
+    if user_id == str(authorized_user_id):
+        metrics = scheduler_metrics.stats()
+        lateness = metrics['lateness']
+        tick_seconds = metrics['tick_seconds']
+
+        lines = [
+            "**Daily update scheduler**",
+            f"Mode: {SCHEDULER_MODE} | Running: {scheduler.is_running}",
+            f"Scheduled: {len(scheduler.fire_times)} | Sent: {metrics['sent']}",
+            f"Backlog: last tick {metrics['last_backlog']} due, max {metrics['max_backlog']}",
+            f"Tick time: p50 ≤{tick_seconds['p50']}s, p95 ≤{tick_seconds['p95']}s, max {tick_seconds['max']:.2f}s over {tick_seconds['count']} ticks",
+            f"Lateness: p50 ≤{lateness['p50']}s, p95 ≤{lateness['p95']}s, max {lateness['max']:.1f}s",
+            f"Lateness histogram: {', '.join(f'{bucket}s {count}' for bucket, count in lateness['buckets'].items())}",
+            f"Failures: {', '.join(f'{cause} {count}' for cause, count in metrics['failures'].items()) or 'none'}",
+        ]
+        if scheduler_metrics.recent_failures:
+            lines += ["", "**Recent failures**"]
+            for failed_at, cause, detail in scheduler_metrics.recent_failures:
+                lines.append(f"{datetime.datetime.utcfromtimestamp(failed_at).strftime('%Y-%m-%d %H:%M:%S')} UTC {cause}: {detail[:150]}")
+        await ctx.followup.send('\n'.join(lines))
     else:
         await ctx.followup.send("You are not authorized to use this command.")
 
 #endregion
 #region Tasks
 
-@tasks.loop(seconds=45)
-async def send_daily_updates():
-    current_utc_time = datetime.datetime.utcnow().time()
-    current_minute = current_utc_time.minute
-    for user_id, user_data in data.items():
+# Function to send a batch of due daily updates, each unique location is only fetched once
+async def send_daily_updates(due):
+    # Group recipients by location
+    recipients_by_location = {}
+    locations = {}
+    fire_times = dict(due)
+    for user_id, fire_time in due:
+        location = data.get(user_id, {}).get('location')
+        if not location:
+            scheduler_metrics.record_failure('no_location', f'user {user_id}')
+            continue
+        location_key = normalize_location(location)
+        recipients_by_location.setdefault(location_key, []).append(user_id)
+        locations.setdefault(location_key, location)
+
+    # Fetch every unique location concurrently, the quota governor keeps this within the API limits
+    location_keys = list(recipients_by_location)
+    results = await asyncio.gather(
+        *(owm.current_weather(locations[location_key], priority=PRIORITY_SCHEDULED) for location_key in location_keys),
+        return_exceptions=True,
+    )
+
+    deliveries = []
+    for location_key, result in zip(location_keys, results):
+        if isinstance(result, Exception) or result[0] != 200:
+            detail = result if isinstance(result, Exception) else f"HTTP {result[0]} {result[1].get('message', '')}"
+            # Once the daily budget is spent uncached locations are turned away right away instead of waiting for midnight
+            cause = 'quota_exhausted' if not isinstance(result, Exception) and result[0] == 429 else 'weather_fetch'
+            scheduler_metrics.record_failure(cause, f'{locations[location_key]}: {detail}')
+            continue
+
+        weather = result[1]
+        for user_id in recipients_by_location[location_key]:
+            deliveries.append((user_id, weather))
+
+    # Send the DMs concurrently, discord.py's HTTP client still waits out any rate-limited buckets
+    semaphore = asyncio.Semaphore(DAILY_UPDATE_DM_CONCURRENCY)
+
+    async def deliver(user_id, weather):
+        async with semaphore:
+            await send_daily_update(user_id, weather)
+
+    fan_out_start = time.monotonic()
+    send_results = await asyncio.gather(*(deliver(user_id, weather) for user_id, weather in deliveries), return_exceptions=True)
+    fan_out_seconds = time.monotonic() - fan_out_start
+
+    for (user_id, _), result in zip(deliveries, send_results):
+        if isinstance(result, Exception):
+            scheduler_metrics.record_failure('dm_error', f'user {user_id}: {result}')
+        elif result:
+            scheduler_metrics.record_sent(fire_times[user_id])
+
+    daily_update_stats['ticks'] += 1
+    daily_update_stats['recipients'] += len(deliveries)
+    daily_update_stats['unique_locations'] += len(location_keys)
+    daily_update_stats['last_tick_recipients'] = len(deliveries)
+    daily_update_stats['last_tick_unique_locations'] = len(location_keys)
+    daily_update_stats['last_fan_out_seconds'] = fan_out_seconds
+    daily_update_stats['max_fan_out_seconds'] = max(daily_update_stats['max_fan_out_seconds'], fan_out_seconds)
+
+# Function to warm the weather cache for daily updates due soon, spreading the requests evenly until the deadline
+async def prefetch_daily_updates(user_ids, deadline):
+    locations = {}
+    for user_id in user_ids:
+        location = data.get(user_id, {}).get('location')
+        if location:
+            locations.setdefault(normalize_location(location), location)
+    if not locations:
+        return
+
+    start = time.time()
+    spacing = max(0, deadline - start) / len(locations)
+    for index, location in enumerate(locations.values()):
+        await asyncio.sleep(max(0, start + index * spacing - time.time()))
+        await owm.current_weather(location, priority=PRIORITY_PREFETCH)
+
+# Function to send one user their daily weather update, returns True if it was delivered.
+# The DM channel id is saved with the user so later sends skip fetch_user and create_dm.
+async def send_daily_update(user_id, weather):
+    user_data = data.get(user_id, {})
+    location = user_data.get('location')
+    unit = user_data.get('unit', 'C')
+    message = (f'Daily weather update for {location}: {weather.main} ({weather.description}) with a temperature of '
+               f'{weather.format_temperature(unit)}.{stale_note(weather, refreshing=False)}')
+
+    channel_id = user_data.get('dm_channel_id')
+    if channel_id:
         try:
-            update_time = datetime.datetime.strptime(user_data['daily_update_time'], '%H:%M').time()
-            user_tz = pytz.timezone(user_data['timezone'])
-            user_local_time = user_tz.localize(datetime.datetime.combine(datetime.date.today(), update_time))
-            user_utc_time = user_local_time.astimezone(pytz.utc).time()
-
-            print(f"Checking updates for user {user_id}:")
-            print(f"Current UTC time: {current_utc_time}")
-            print(f"User's local time: {user_local_time}")
-            print(f"User's UTC time: {user_utc_time}")
-
-            # If it's the correct time for the user and the update hasn't been sent yet, send the update
-            if current_utc_time.hour == user_utc_time.hour and current_utc_time.minute == user_utc_time.minute:
-                if user_id not in sent_updates:
-                    location = user_data.get('location')
-
-                    if location:
-                        # Fetch weather data (assuming the API part is correct)
-                        weather_api_url = f'http://api.openweathermap.org/data/2.5/weather?q={location}&appid={OPENWEATHERMAP_API_KEY}'
-                        response = requests.get(weather_api_url)
-                        weather_data = response.json()
-
-                        if response.status_code == 200:
-                            main_weather = weather_data['weather'][0]['main']
-                            description = weather_data['weather'][0]['description']
-                            temperature = weather_data['main']['temp']
-                            unit = user_data.get('unit', 'C')
-
-                            if unit == 'F':
-                                temperature = (temperature * 9/5) + 32
-
-                            user = await bot.fetch_user(int(user_id))
-                            if user:
-                                print(f"User {user_id} found: {user}")
-                                # Send DM to the user
-                                try:
-                                    channel = await user.create_dm()
-                                    await channel.send(f'Daily weather update for {location}: {main_weather} ({description}) with a temperature of {temperature:.2f}°{"F" if unit == "F" else "C"}.')
-                                    print(f"Sent update to user {user_id}")
-                                    sent_updates.add(user_id)
-                                except discord.Forbidden:
-                                    print(f"Bot does not have permission to send DMs to user {user_id}")
-                            else:
-                                print(f"User {user_id} not found.")
-                        else:
-                            print(f"Unable to fetch daily weather update for {location}.")
-                    else:
-                        print(f"No location found for user {user_id}.")
-        except Exception as e:
-            pass
-
-    # Clear the set of sent updates if the minute has changed
-    if current_utc_time.minute != current_minute:
-        sent_updates.clear()
+            await bot.get_partial_messageable(channel_id, type=discord.ChannelType.private).send(message)
+            return True
+        except (discord.Forbidden, discord.NotFound):
+            # The saved channel can't be used anymore, resolve it again below
+            user_data.pop('dm_channel_id', None)
+            learned_dm_channels.pop(user_id, None)
+
+    try:
+        user = await bot.fetch_user(int(user_id))
+    except discord.NotFound:
+        scheduler_metrics.record_failure('user_not_found', f'user {user_id}')
+        return False
+
+    # Send DM to the user
+    try:
+        channel = await user.create_dm()
+        await channel.send(message)
+        user_data['dm_channel_id'] = channel.id
+        if SCHEDULER_MODE == 'worker':
+            learned_dm_channels[user_id] = channel.id
+        return True
+    except discord.Forbidden:
+        scheduler_metrics.record_failure('dm_forbidden', f'user {user_id}')
+        return False
+
+# Scheduler that sleeps until the next subscriber is due instead of scanning every user
+# Workers treat user_data.json as read-only, the bot process owns it
+scheduler = DailyUpdateScheduler(send_daily_updates, save=save_users if SCHEDULER_MODE != 'worker' else None,
+                                 ledger=SentLedger(LEDGER_FILE, peer_pattern=LEDGER_PEER_PATTERN),
+                                 catchup_window=DAILY_UPDATE_CATCHUP_WINDOW,
+                                 prefetch=prefetch_daily_updates, prefetch_lead=DAILY_UPDATE_PREFETCH_LEAD,
+                                 smoothing_window=DAILY_UPDATE_SMOOTHING_WINDOW, metrics=scheduler_metrics)
 
 #endregion
 #region Events
@@ -1070,28 +1360,81 @@ async def send_daily_updates():
 # Event to print a message when the bot is ready
 @bot.event
 async def on_ready():
-    send_daily_updates.start()
+    await owm.open()
+    await start_metrics()
+    persister.start()
+    if SCHEDULER_MODE == 'local' and not scheduler.is_running:
+        scheduler.load(data)
+        scheduler.start()
+    elif SCHEDULER_MODE == 'off':
+        # Workers send the updates, this process only keeps next fire times up to date for /dailyupdate
+        scheduler.load(data)
     await bot.tree.sync()
     print(f'{bot.user.name} has connected to Discord!')
 
 @bot.event
 async def on_disconnect():
-    write_data(data)
+    await persister.flush()
 
-# Run the bot
-bot.run(DISCORD_TOKEN, reconnect=True)
-# Event to print a message when the bot is ready
-@bot.event
-async def on_ready():
-    send_daily_updates.start()
-    await bot.tree.sync()
-    print(f'{bot.user.name} has connected to Discord!')
+# Function to start the metrics endpoint once, if METRICS_PORT is set
+async def start_metrics():
+    global metrics_runner
+    if METRICS_PORT and metrics_runner is None:
+        metrics_runner = await start_metrics_server(scheduler_metrics, METRICS_HOST, METRICS_PORT)
 
-@bot.event
-async def on_disconnect():
-    write_data(data)
+# Function to run this process as a daily update worker that owns a slice of the subscribers
+async def run_scheduler_worker():
+    global data
+
+    # Only the REST API is needed to send DMs, so log in without opening a gateway connection
+    await bot.login(DISCORD_TOKEN)
+    await owm.open()
+    await start_metrics()
+
+    coordinator = ShardCoordinator(SHARD_LEASE_FILE, SCHEDULER_WORKER_ID, slice_count=SHARD_SLICE_COUNT, lease_ttl=SHARD_LEASE_TTL)
+    scheduler.owns = coordinator.owns
+    data_version = None
+
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            try:
+                slices_changed = await loop.run_in_executor(None, coordinator.heartbeat)
+            except sqlite3.OperationalError as e:
+                # The leases lapse on their own if this keeps failing, owns() stops sending once they do
+                print(f"Worker {SCHEDULER_WORKER_ID} heartbeat failed: {e}")
+                await asyncio.sleep(SHARD_LEASE_TTL / 3)
+                continue
+
+            # Pick up subscriptions changed by the bot process and slices that moved here. Reading runs off the
+            # event loop, and only new or changed subscriptions get their fire times worked out again.
+            version = user_store.version()
+            if slices_changed or version != data_version:
+                data_version = version
+                loaded = await loop.run_in_executor(None, read_data)
+                for user_id, channel_id in learned_dm_channels.items():
+                    if user_id in loaded:
+                        loaded[user_id]['dm_channel_id'] = channel_id
+                if slices_changed:
+                    # Updates the previous owner already sent must not go out again
+                    await scheduler.ledger.refresh()
+                data = loaded
+                scheduler.refresh(data)
+                print(f"Worker {SCHEDULER_WORKER_ID} owns {len(coordinator.owned)} of {SHARD_SLICE_COUNT} slices "
+                      f"({len(scheduler.fire_times)} subscribers)")
+
+            scheduler.start()
+            await asyncio.sleep(SHARD_LEASE_TTL / 3)
+    finally:
+        scheduler.stop()
+        await loop.run_in_executor(None, coordinator.leave)
+        await owm.close()
+        await bot.close()
 
 #endregion
 
-# Run the bot
-bot.run(DISCORD_TOKEN, reconnect=True)
\ No newline at end of file
+# Run the bot, or only the daily update scheduler in worker mode
+if SCHEDULER_MODE == 'worker':
+    asyncio.run(run_scheduler_worker())
+else:
+    bot.run(DISCORD_TOKEN, reconnect=True)
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import asyncio
+from collections import OrderedDict
+import concurrent.futures
+import os
+import time
+from userStore import load_snapshot, write_snapshot
+
+#endregion
+#region Helper Functions
+
+# Function to normalize a location so "Calgary,  CA" and "calgary, ca" share a cache entry
+def normalize_location(location):
+    parts = [' '.join(part.split()) for part in location.lower().split(',')]
+    return ','.join(part for part in parts if part)
+
+# Function to snap coordinates to the centre of a grid cell (grid in degrees, 0 keeps them as they are)
+def snap_to_grid(lat, lon, grid=0.05):
+    if not grid:
+        return lat, lon
+    return round(round(lat / grid) * grid, 6), round(round(lon / grid) * grid, 6)
+
+#endregion
+#region Caches
+
+# Size-bounded in-memory cache where every entry carries its own expiry time.
+# Entries past their expiry are still served as stale for `grace` seconds while they get refreshed.
+class TTLCache:
+    def __init__(self, ttl=600, max_entries=1000, min_ttl=60, grace=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.grace = grace
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.merged_hits = 0  # hits on an entry that was stored for a different origin (e.g. another spelling)
+
+    # Function to look up a cached value, returns (value, cached_at, is_fresh) or None if missing or too old
+    def lookup(self, key, origin=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, cached_at, expires_at, entry_origin = entry
+        now = time.time()
+        if expires_at + self.grace <= now:
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        if origin is not None and origin != entry_origin:
+            self.merged_hits += 1
+        is_fresh = expires_at > now
+        if is_fresh:
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return value, cached_at, is_fresh
+
+    # Function to get a fresh cached value, returns None if missing or expired
+    def get(self, key):
+        entry = self.lookup(key)
+        if entry is None or not entry[2]:
+            return None
+        return entry[0]
+
+    # Function to store a value, the expiry follows the observation time (dt) if one is given
+    def set(self, key, value, observed_at=None, origin=None):
+        now = time.time()
+        expires_at = now + self.ttl
+        if observed_at is not None:
+            # OWM refreshes roughly every ttl seconds after dt, but never cache for less than min_ttl
+            expires_at = min(expires_at, max(observed_at + self.ttl, now + self.min_ttl))
+
+        self.entries[key] = (value, now, expires_at, origin)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'merged_hits': self.merged_hits,
+            'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            'unmerged_hit_rate': (self.hits + self.stale_hits - self.merged_hits) / lookups if lookups else 0.0,
+        }
+
+# Geocoding results never change for a given location string, so keep them on disk across restarts.
+# Changes are written at most once every flush_delay seconds, off the event loop, and on close.
+class GeocodeCache:
+    def __init__(self, path, flush_delay=5):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.entries = self.load()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.flush_handle = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    # Function to load the cache, a damaged file falls back to the previous copy (path.1)
+    def load(self):
+        entries, _ = load_snapshot(self.path, backups=1)
+        return entries
+
+    # Function to write entries atomically, every process writes through its own temp file
+    def save(self, entries):
+        write_snapshot(self.path, entries, backups=1, temp_path=f'{self.path}.{os.getpid()}.tmp')
+
+    # Function to write the cache after flush_delay seconds, changes made meanwhile go in the same write
+    def _schedule_flush(self):
+        self.dirty = True
+        if self.flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts), nothing to block
+            self.dirty = False
+            self.save(dict(self.entries))
+            return
+        self.flush_handle = loop.call_later(self.flush_delay, lambda: loop.create_task(self.flush()))
+
+    # Function to write pending changes now, called on close so nothing is lost on shutdown
+    async def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.dirty:
+            return
+
+        self.dirty = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.save, dict(self.entries))
+        except OSError as e:
+            print(f"Failed to save the geocode cache: {e}")
+            self.dirty = True
+
+    # Function to get the cached coordinates for a location, returns None if not cached
+    def get(self, location):
+        entry = self.entries.get(normalize_location(location))
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    # Function to store the first geocoding result for a location
+    def set(self, location, result):
+        self.entries[normalize_location(location)] = {
+            'name': result.get('name'),
+            'lat': result['lat'],
+            'lon': result['lon'],
+            'country': result.get('country'),
+            'state': result.get('state'),
+        }
+        self._schedule_flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+#endregion
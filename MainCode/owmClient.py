@@ -0,0 +1,313 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import asyncio
+import aiohttp
+from owmCache import GeocodeCache, TTLCache, normalize_location, snap_to_grid
+from owmQuota import PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, QuotaExhausted, QuotaGovernor, QuotaTicket
+from owmResilience import CircuitBreaker, backoff_delay, is_retryable_status
+from weatherSnapshot import WeatherSnapshot
+
+#endregion
+#region Variables
+
+OWM_BASE_URL = 'http://api.openweathermap.org'
+
+# OpenWeatherMap endpoints used by the bot
+CURRENT_WEATHER_PATH = '/data/2.5/weather'
+FORECAST_PATH = '/data/2.5/forecast'
+DAILY_FORECAST_PATH = '/data/2.5/forecast/daily'
+AIR_POLLUTION_PATH = '/data/2.5/air_pollution'
+GEOCODING_PATH = '/geo/1.0/direct'
+
+# Forecast responses are much larger, so they get a longer read timeout
+SLOW_ENDPOINTS = {FORECAST_PATH, DAILY_FORECAST_PATH}
+
+# Longest Retry-After (seconds) we are willing to honour before retrying a 429
+MAX_RETRY_AFTER = 30
+
+#endregion
+#region Helper Functions
+
+# Function to copy a cached value tagged with the time it was cached
+def stale_copy(value, cached_at):
+    if isinstance(value, dict):
+        return dict(value, cached_at=cached_at)
+    return value.with_cached_at(cached_at)
+
+#endregion
+#region Client
+
+# Async OpenWeatherMap client, every call returns (status, json) so handlers never block the event loop
+class OWMClient:
+    def __init__(self, api_key, max_connections=100, max_connections_per_host=20, dns_cache_ttl=300, keepalive_timeout=30,
+                 weather_cache_ttl=600, weather_cache_size=1000, geocode_cache_file=None,
+                 calls_per_minute=60, calls_per_day=0,
+                 forecast_cache_ttl=1800, air_pollution_cache_ttl=1800, stale_grace=0,
+                 connect_timeout=3, read_timeout=5, slow_read_timeout=10, max_retries=2,
+                 breaker_threshold=5, breaker_reset=30, grid_size=0.05):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+
+        # Current conditions only refresh about every 10 minutes, so serve repeats from memory
+        self.weather_cache = TTLCache(ttl=weather_cache_ttl, max_entries=weather_cache_size, grace=stale_grace)
+
+        # Caches are keyed by coordinates snapped to a grid, so spelling variants and nearby places share entries
+        self.grid_size = grid_size
+
+        # Forecast and air pollution responses keyed by coordinates
+        self.forecast_cache = TTLCache(ttl=forecast_cache_ttl, max_entries=weather_cache_size, grace=stale_grace)
+        self.air_pollution_cache = TTLCache(ttl=air_pollution_cache_ttl, max_entries=weather_cache_size, grace=stale_grace)
+
+        # Persistent location -> coordinates cache, lets coordinate-based commands skip the geocoding call
+        self.geocode_cache = GeocodeCache(geocode_cache_file) if geocode_cache_file else None
+
+        # Every outbound call spends a token from the API key's budget
+        self.quota = QuotaGovernor(calls_per_minute=calls_per_minute, calls_per_day=calls_per_day)
+
+        # Per-endpoint timeouts, bounded retries and a circuit breaker so a stalled OWM can't hang handlers
+        self.timeouts = {
+            path: aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=slow_read_timeout if path in SLOW_ENDPOINTS else read_timeout)
+            for path in (CURRENT_WEATHER_PATH, FORECAST_PATH, DAILY_FORECAST_PATH, AIR_POLLUTION_PATH, GEOCODING_PATH)
+        }
+        self.default_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.breaker = CircuitBreaker(failure_threshold=breaker_threshold, reset_timeout=breaker_reset)
+        self.retries = 0
+        self.timeouts_hit = 0
+
+        # Requests currently on the wire as (task, quota ticket), identical concurrent requests wait on the same task
+        self.in_flight = {}
+
+        # Background refreshes of stale cache entries, kept referenced until they finish
+        self.revalidating = {}
+        self.revalidations = 0
+
+        # Connection counters, a high reuse count means keep-alive is doing its job
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.requests_sent = 0
+        self.requests_coalesced = 0
+
+    @property
+    def is_open(self):
+        return self.session is not None and not self.session.closed
+
+    # Function to create the shared pooled session (safe to call more than once)
+    async def open(self):
+        if self.is_open:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.max_connections_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    # Function to close the shared session on shutdown and write any unsaved geocoding results
+    async def close(self):
+        if self.geocode_cache is not None:
+            await self.geocode_cache.flush()
+        if self.is_open:
+            await self.session.close()
+        self.session = None
+
+    async def _on_connection_created(self, session, context, params):
+        self.connections_created += 1
+
+    async def _on_connection_reused(self, session, context, params):
+        self.connections_reused += 1
+
+    # Function to report connection pool usage
+    def stats(self):
+        total = self.connections_created + self.connections_reused
+        return {
+            'requests_sent': self.requests_sent,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'connection_reuse_rate': self.connections_reused / total if total else 0.0,
+            'requests_coalesced': self.requests_coalesced,
+            'requests_in_flight': len(self.in_flight),
+            'revalidations': self.revalidations,
+            'retries': self.retries,
+            'timeouts': self.timeouts_hit,
+        }
+
+    # Function to perform a GET request, concurrent identical requests share one round trip
+    async def get(self, path, params, priority=PRIORITY_INTERACTIVE):
+        key = (path, tuple(sorted(params.items())))
+        if key in self.in_flight:
+            task, ticket = self.in_flight[key]
+            self.requests_coalesced += 1
+            # A more urgent caller moves the shared request up the quota queue instead of waiting at its priority
+            self.quota.raise_priority(ticket, priority)
+        else:
+            ticket = QuotaTicket(priority)
+            task = asyncio.ensure_future(self._fetch(path, params, ticket))
+            self.in_flight[key] = (task, ticket)
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+        # Shield so one cancelled caller doesn't cancel the request for everyone else
+        return await asyncio.shield(task)
+
+    # Function to send a GET request to OpenWeatherMap, retrying 5xx/429 and network errors with jittered backoff
+    async def _fetch(self, path, params, ticket):
+        if not self.breaker.allow():
+            return 503, {'message': 'OpenWeatherMap is unavailable, requests are paused.'}
+
+        status, payload, retry_after = 503, {'message': 'Unable to reach OpenWeatherMap.'}, None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(retry_after if retry_after is not None else backoff_delay(attempt - 1))
+
+            try:
+                await self.quota.acquire(ticket=ticket)
+            except QuotaExhausted as e:
+                self.breaker.release_probe()
+                return 429, {'message': str(e)}
+
+            try:
+                status, payload, retry_after = await self._request(path, params)
+            except asyncio.TimeoutError:
+                self.timeouts_hit += 1
+                status, payload, retry_after = 504, {'message': 'OpenWeatherMap took too long to respond.'}, None
+                continue
+            except aiohttp.ClientError as e:
+                status, payload, retry_after = 503, {'message': str(e)}, None
+                continue
+
+            if not is_retryable_status(status):
+                self.breaker.record_success()
+                return status, payload
+
+        self.breaker.record_failure()
+        return status, payload
+
+    # Function to send a single GET request, returns (status, json, retry_after)
+    async def _request(self, path, params):
+        if not self.is_open:
+            await self.open()
+
+        query = dict(params, appid=self.api_key)
+        self.requests_sent += 1
+        timeout = self.timeouts.get(path, self.default_timeout)
+        async with self.session.get(f'{OWM_BASE_URL}{path}', params=query, timeout=timeout) as response:
+            try:
+                payload = await response.json(content_type=None)
+            except ValueError:
+                payload = {}
+
+            retry_after = None
+            if response.status == 429:
+                try:
+                    retry_after = min(float(response.headers.get('Retry-After', '')), MAX_RETRY_AFTER)
+                except ValueError:
+                    pass
+            return response.status, payload, retry_after
+
+    # Function to read through a cache, stale entries are returned right away and refreshed in the background.
+    # Stale responses are copies tagged with 'cached_at' so handlers can tell the user how old they are.
+    # If parse is given, the parsed value is cached instead of the raw payload.
+    # origin identifies what the caller actually asked for, so the cache can count hits shared between different queries.
+    async def cached_get(self, cache, cache_key, path, params, priority, observed_at=None, parse=None, origin=None):
+        cached = cache.lookup(cache_key, origin=origin)
+        if cached is not None:
+            value, cached_at, is_fresh = cached
+            if is_fresh:
+                return 200, value
+
+            revalidate_key = (path, cache_key)
+            if revalidate_key not in self.revalidating:
+                task = asyncio.ensure_future(self._revalidate(cache, cache_key, path, params, observed_at, parse, origin))
+                self.revalidating[revalidate_key] = task
+                task.add_done_callback(lambda _: self.revalidating.pop(revalidate_key, None))
+            return 200, stale_copy(value, cached_at)
+
+        status, payload = await self.get(path, params, priority)
+        if status == 200:
+            payload = self._store(cache, cache_key, payload, observed_at, parse, origin)
+        return status, payload
+
+    def _store(self, cache, cache_key, payload, observed_at, parse, origin):
+        value = parse(payload) if parse else payload
+        cache.set(cache_key, value, observed_at=observed_at(payload) if observed_at else None, origin=origin)
+        return value
+
+    async def _revalidate(self, cache, cache_key, path, params, observed_at, parse, origin):
+        self.revalidations += 1
+        try:
+            status, payload = await self.get(path, params, PRIORITY_PREFETCH)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return
+        if status == 200:
+            self._store(cache, cache_key, payload, observed_at, parse, origin)
+
+    # Function to get the current weather as a WeatherSnapshot (or the raw error payload), read through the TTL cache
+    async def current_weather(self, location, priority=PRIORITY_INTERACTIVE):
+        geocoding_status, geocoding_data = await self.geocode(location, priority)
+        if geocoding_status != 200:
+            return geocoding_status, geocoding_data
+        if not geocoding_data:
+            return 404, {'message': 'city not found'}
+
+        lat, lon = snap_to_grid(geocoding_data[0]['lat'], geocoding_data[0]['lon'], self.grid_size)
+        return await self.cached_get(self.weather_cache, (lat, lon), CURRENT_WEATHER_PATH, {'lat': lat, 'lon': lon}, priority,
+                                     observed_at=lambda payload: payload.get('dt'), parse=WeatherSnapshot.from_payload,
+                                     origin=normalize_location(location))
+
+    # Function to resolve a location to coordinates, read through the geocoding cache
+    async def geocode(self, location, priority=PRIORITY_INTERACTIVE):
+        if self.geocode_cache is not None:
+            cached = self.geocode_cache.get(location)
+            if cached is not None:
+                return 200, [cached]
+
+        status, payload = await self.get(GEOCODING_PATH, {'q': location}, priority)
+        if status == 200 and payload and self.geocode_cache is not None:
+            self.geocode_cache.set(location, payload[0])
+        return status, payload
+
+    async def forecast(self, lat, lon, priority=PRIORITY_INTERACTIVE):
+        cell_lat, cell_lon = snap_to_grid(lat, lon, self.grid_size)
+        return await self.cached_get(self.forecast_cache, (FORECAST_PATH, cell_lat, cell_lon), FORECAST_PATH,
+                                     {'lat': cell_lat, 'lon': cell_lon}, priority, origin=(lat, lon))
+
+    async def daily_forecast(self, lat, lon, cnt=16, priority=PRIORITY_INTERACTIVE):
+        cell_lat, cell_lon = snap_to_grid(lat, lon, self.grid_size)
+        return await self.cached_get(self.forecast_cache, (DAILY_FORECAST_PATH, cell_lat, cell_lon, cnt), DAILY_FORECAST_PATH,
+                                     {'lat': cell_lat, 'lon': cell_lon, 'cnt': cnt}, priority, origin=(lat, lon))
+
+    async def air_pollution(self, lat, lon, priority=PRIORITY_INTERACTIVE):
+        cell_lat, cell_lon = snap_to_grid(lat, lon, self.grid_size)
+        return await self.cached_get(self.air_pollution_cache, (cell_lat, cell_lon), AIR_POLLUTION_PATH,
+                                     {'lat': cell_lat, 'lon': cell_lon}, priority, origin=(lat, lon))
+
+#endregion
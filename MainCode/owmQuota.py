@@ -0,0 +1,187 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import asyncio
+import datetime
+import heapq
+import itertools
+import time
+
+#endregion
+#region Variables
+
+# Priority classes, lower numbers are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+PRIORITY_PREFETCH = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_SCHEDULED: 'scheduled',
+    PRIORITY_PREFETCH: 'prefetch',
+}
+
+#endregion
+#region Quota Governor
+
+# Raised when the daily budget is spent and an interactive call can't wait until tomorrow
+class QuotaExhausted(Exception):
+    pass
+
+# A caller's place in the quota queue. Its priority can be raised while it waits,
+# so an interactive caller that joins a queued prefetch request doesn't wait at prefetch priority.
+class QuotaTicket:
+    def __init__(self, priority=PRIORITY_INTERACTIVE):
+        self.priority = priority
+        self.future = None
+
+# Token bucket shared by every outbound OWM call, waiting calls are released in priority order
+class QuotaGovernor:
+    def __init__(self, calls_per_minute=60, calls_per_day=0):
+        self.calls_per_minute = calls_per_minute
+        self.calls_per_day = calls_per_day  # 0 means no daily limit
+
+        self.tokens = float(calls_per_minute)
+        self.last_refill = time.monotonic()
+        self.day = datetime.datetime.utcnow().date()
+        self.calls_today = 0
+
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.dispatcher = None
+
+        self.granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self.queued = {priority: 0 for priority in PRIORITY_NAMES}
+        self.rejected = 0
+        self.raised = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.calls_per_minute, self.tokens + (now - self.last_refill) * self.calls_per_minute / 60)
+        self.last_refill = now
+
+        today = datetime.datetime.utcnow().date()
+        if today != self.day:
+            self.day = today
+            self.calls_today = 0
+
+    def _daily_budget_spent(self):
+        return self.calls_per_day and self.calls_today >= self.calls_per_day
+
+    def _take(self, priority):
+        self.tokens -= 1
+        self.calls_today += 1
+        self.granted[priority] += 1
+
+    # Only prefetches wait for the daily budget to reset, anything else would stall a user or a daily update tick until midnight
+    def _must_reject(self, priority):
+        return self._daily_budget_spent() and priority != PRIORITY_PREFETCH
+
+    def _reject(self):
+        self.rejected += 1
+        return QuotaExhausted('Daily OpenWeatherMap call budget has been used up.')
+
+    # Function to wait for permission to make one OWM call, pass a ticket to be able to raise its priority later
+    async def acquire(self, priority=PRIORITY_INTERACTIVE, ticket=None):
+        if ticket is None:
+            ticket = QuotaTicket(priority)
+        priority = ticket.priority
+        self._refill()
+
+        if self._must_reject(priority):
+            raise self._reject()
+
+        # Fast path, nothing is queued ahead of us and a token is available
+        if not self.waiters and self.tokens >= 1 and not self._daily_budget_spent():
+            self._take(priority)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self.queued[priority] += 1
+        ticket.future = future
+
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+
+        try:
+            await future
+        finally:
+            ticket.future = None
+
+    # Function to move a ticket up to a more urgent priority, a queued ticket is pushed again at the new priority
+    # (the old heap entry is skipped once its future is done)
+    def raise_priority(self, ticket, priority):
+        if priority >= ticket.priority:
+            return
+        ticket.priority = priority
+        future = ticket.future
+        if future is None or future.done():
+            return
+
+        self.raised += 1
+        if self._must_reject(priority):
+            future.set_exception(self._reject())
+            return
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+
+    # Background task that hands out tokens to queued callers as they refill
+    async def _dispatch(self):
+        while self.waiters:
+            self._refill()
+
+            # Drop callers that gave up while waiting
+            while self.waiters and self.waiters[0][2].done():
+                heapq.heappop(self.waiters)
+            if not self.waiters:
+                break
+
+            if self._daily_budget_spent():
+                # Turn away everyone but prefetches, they are the only ones allowed to wait for the reset
+                for priority, _, future in self.waiters:
+                    if not future.done() and self._must_reject(priority):
+                        future.set_exception(self._reject())
+                self.waiters = [waiter for waiter in self.waiters if not waiter[2].done()]
+                heapq.heapify(self.waiters)
+                if not self.waiters:
+                    break
+
+                tomorrow = datetime.datetime.combine(self.day + datetime.timedelta(days=1), datetime.time())
+                await asyncio.sleep(max(1, (tomorrow - datetime.datetime.utcnow()).total_seconds()))
+                continue
+
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) * 60 / self.calls_per_minute)
+                continue
+
+            priority, _, future = heapq.heappop(self.waiters)
+            self._take(priority)
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            'tokens': self.tokens,
+            'calls_today': self.calls_today,
+            'waiting': len(self.waiters),
+            'rejected': self.rejected,
+            'raised': self.raised,
+            'granted': {PRIORITY_NAMES[priority]: count for priority, count in self.granted.items()},
+            'queued': {PRIORITY_NAMES[priority]: count for priority, count in self.queued.items()},
+        }
+
+#endregion
@@ -0,0 +1,99 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import random
+import time
+
+#endregion
+#region Variables
+
+# Circuit breaker states
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+#endregion
+#region Helper Functions
+
+# Function to check whether a response status is worth retrying
+def is_retryable_status(status):
+    return status == 429 or status >= 500
+
+# Function to get a "full jitter" exponential backoff delay for a retry attempt (starting at 0)
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+#endregion
+#region Circuit Breaker
+
+# Stops sending requests after repeated failures, then lets a single probe through once reset_timeout has passed
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    # Function to check whether a request may be sent right now
+    def allow(self):
+        if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = BREAKER_HALF_OPEN
+            self.probe_in_flight = False
+
+        if self.state == BREAKER_CLOSED:
+            return True
+
+        if self.state == BREAKER_HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+
+        self.short_circuited += 1
+        return False
+
+    # Function to give back a half-open probe slot that never reached OWM
+    def release_probe(self):
+        self.probe_in_flight = False
+
+    def record_success(self):
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == BREAKER_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != BREAKER_OPEN:
+                self.times_opened += 1
+            self.state = BREAKER_OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'times_opened': self.times_opened,
+            'short_circuited': self.short_circuited,
+        }
+
+#endregion
@@ -0,0 +1,168 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import bisect
+import collections
+import time
+from aiohttp import web
+
+#endregion
+#region Variables
+
+# Histogram bucket upper bounds in seconds
+LATENESS_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600)
+TICK_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 300)
+
+# How many recent failures are kept for /schedulerstats
+RECENT_FAILURES = 10
+
+#endregion
+#region Histogram
+
+# Fixed-bucket histogram, cheap enough to update on every send
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket holds everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Function to estimate a quantile (0-1) as the upper bound of the bucket it falls in
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': self.max,
+            'buckets': self.bucket_counts(),
+        }
+
+    # Function to get the count in each bucket, labelled like {'<=1': 3, '<=5': 0, ..., '>3600': 1}
+    def bucket_counts(self):
+        counts = {f'<={bound}': count for bound, count in zip(self.buckets, self.counts)}
+        counts[f'>{self.buckets[-1]}'] = self.counts[-1]
+        return counts
+
+#endregion
+#region Scheduler Metrics
+
+# Everything the daily update scheduler measures: how late each update went out, how long ticks take,
+# how many subscribers were due at once and what went wrong, counted by cause
+class SchedulerMetrics:
+    def __init__(self):
+        self.lateness = Histogram(LATENESS_BUCKETS)
+        self.tick_seconds = Histogram(TICK_BUCKETS)
+        self.last_backlog = 0
+        self.max_backlog = 0
+        self.scheduled = 0
+        self.sent = 0
+        self.failures = collections.Counter()
+        self.recent_failures = collections.deque(maxlen=RECENT_FAILURES)
+
+    # Function to record one delivered update, fire_time is the epoch it was scheduled for
+    def record_sent(self, fire_time):
+        self.sent += 1
+        self.lateness.observe(max(0.0, time.time() - fire_time))
+
+    # Function to record one tick, backlog is how many subscribers were due when it started
+    def record_tick(self, seconds, backlog, scheduled):
+        self.tick_seconds.observe(seconds)
+        self.last_backlog = backlog
+        self.max_backlog = max(self.max_backlog, backlog)
+        self.scheduled = scheduled
+
+    def record_failure(self, cause, detail=''):
+        self.failures[cause] += 1
+        self.recent_failures.append((time.time(), cause, str(detail)))
+
+    def stats(self):
+        return {
+            'scheduled': self.scheduled,
+            'sent': self.sent,
+            'last_backlog': self.last_backlog,
+            'max_backlog': self.max_backlog,
+            'lateness': self.lateness.stats(),
+            'tick_seconds': self.tick_seconds.stats(),
+            'failures': dict(self.failures),
+        }
+
+    # Function to render the metrics in the Prometheus text format
+    def render(self):
+        lines = [
+            '# TYPE weatherbot_daily_updates_scheduled gauge',
+            f'weatherbot_daily_updates_scheduled {self.scheduled}',
+            '# TYPE weatherbot_daily_updates_sent_total counter',
+            f'weatherbot_daily_updates_sent_total {self.sent}',
+            '# TYPE weatherbot_daily_update_backlog gauge',
+            f'weatherbot_daily_update_backlog {self.last_backlog}',
+            '# TYPE weatherbot_daily_update_failures_total counter',
+        ]
+        lines += [f'weatherbot_daily_update_failures_total{{cause="{cause}"}} {count}' for cause, count in sorted(self.failures.items())]
+        lines += render_histogram('weatherbot_daily_update_lateness_seconds', self.lateness)
+        lines += render_histogram('weatherbot_daily_update_tick_seconds', self.tick_seconds)
+        return '\n'.join(lines) + '\n'
+
+# Function to render a histogram in the Prometheus text format (cumulative buckets)
+def render_histogram(name, histogram):
+    lines = [f'# TYPE {name} histogram']
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+    lines += [
+        f'{name}_bucket{{le="+Inf"}} {histogram.count}',
+        f'{name}_sum {histogram.sum}',
+        f'{name}_count {histogram.count}',
+    ]
+    return lines
+
+#endregion
+#region Metrics Server
+
+# Function to serve the metrics at http://host:port/metrics, returns the runner so it can be cleaned up
+async def start_metrics_server(metrics, host, port):
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+#endregion
@@ -0,0 +1,171 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import hashlib
+import sqlite3
+import time
+
+#endregion
+#region Helper Functions
+
+def stable_hash(value):
+    return int(hashlib.md5(value.encode()).hexdigest(), 16)
+
+# Function to get the slice a user belongs to, slices never change when workers come and go
+def slice_for(user_id, slice_count):
+    return stable_hash(str(user_id)) % slice_count
+
+# Function to pick the worker that should own a slice (rendezvous hashing), so a join or leave only moves ~1/n of the slices
+def preferred_owner(slice_id, worker_ids):
+    return max(worker_ids, key=lambda worker_id: stable_hash(f'{worker_id}:{slice_id}'))
+
+#endregion
+#region Shard Coordinator
+
+# Splits daily update subscribers across worker processes on one host.
+# Membership and slice leases live in a SQLite file, every change happens inside a BEGIN IMMEDIATE
+# transaction so two workers can never hold the same slice at once.
+# heartbeat() blocks on the database, run it in an executor so a busy lock never stalls the event loop.
+class ShardCoordinator:
+    def __init__(self, path, worker_id, slice_count=64, lease_ttl=30, busy_timeout=2):
+        self.worker_id = worker_id
+        self.slice_count = slice_count
+        self.lease_ttl = lease_ttl
+        self.owned = set()
+        self.lease_expires = 0
+        self.rebalances = 0
+        self.slices = {}  # user_id -> slice, a user's slice never changes so it is only hashed once
+
+        self.connection = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS slices (slice_id INTEGER PRIMARY KEY, owner TEXT, expires REAL NOT NULL)')
+
+    # Function to check whether this worker currently owns a user's slice.
+    # Once the leases run out without a renewal another worker may have taken the slice, so nothing is owned.
+    def owns(self, user_id):
+        slice_id = self.slices.get(user_id)
+        if slice_id is None:
+            slice_id = self.slices[user_id] = slice_for(user_id, self.slice_count)
+        return time.time() < self.lease_expires and slice_id in self.owned
+
+    # Function to renew this worker's membership and leases, returns True if the owned slices changed
+    def heartbeat(self):
+        now = time.time()
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('INSERT OR REPLACE INTO workers (worker_id, heartbeat) VALUES (?, ?)', (self.worker_id, now))
+            cursor.execute('DELETE FROM workers WHERE heartbeat < ?', (now - self.lease_ttl,))
+            worker_ids = [row[0] for row in cursor.execute('SELECT worker_id FROM workers')]
+            leases = {row[0]: (row[1], row[2]) for row in cursor.execute('SELECT slice_id, owner, expires FROM slices')}
+
+            owned = set()
+            for slice_id in range(self.slice_count):
+                owner, expires = leases.get(slice_id, (None, 0))
+                lease_free = owner is None or owner == self.worker_id or expires < now
+
+                if preferred_owner(slice_id, worker_ids) == self.worker_id and lease_free:
+                    cursor.execute('INSERT OR REPLACE INTO slices (slice_id, owner, expires) VALUES (?, ?, ?)',
+                                   (slice_id, self.worker_id, now + self.lease_ttl))
+                    owned.add(slice_id)
+                elif owner == self.worker_id:
+                    # Another worker should have this slice now, hand it over
+                    cursor.execute('UPDATE slices SET owner = NULL, expires = 0 WHERE slice_id = ?', (slice_id,))
+
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+
+        changed = owned != self.owned
+        if changed:
+            self.rebalances += 1
+        self.owned = owned
+        self.lease_expires = now + self.lease_ttl
+        return changed
+
+    # Function to release every lease and leave the group on shutdown
+    def leave(self):
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('DELETE FROM workers WHERE worker_id = ?', (self.worker_id,))
+            cursor.execute('UPDATE slices SET owner = NULL, expires = 0 WHERE owner = ?', (self.worker_id,))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        self.owned = set()
+        self.lease_expires = 0
+        self.connection.close()
+
+#endregion
+#region Checks
+
+# Function to check that two workers never own the same slice: while one joins, while slices are handed over,
+# after one stops heartbeating and after one leaves. Raises AssertionError on a violation.
+def check_lease_exclusivity():
+    import os
+    import tempfile
+
+    def check_disjoint(step, *workers):
+        for index, worker in enumerate(workers):
+            for other in workers[index + 1:]:
+                assert not worker.owned & other.owned, f'{step}: slices {sorted(worker.owned & other.owned)} owned twice'
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'leases.db')
+        first = ShardCoordinator(path, 'first', slice_count=16, lease_ttl=1)
+        second = ShardCoordinator(path, 'second', slice_count=16, lease_ttl=1)
+
+        first.heartbeat()
+        assert len(first.owned) == 16, 'a lone worker should own every slice'
+
+        # The second worker can't take slices while the first one's leases are live
+        second.heartbeat()
+        check_disjoint('join', first, second)
+        assert not second.owned, 'a joining worker took slices that were still leased'
+
+        # The first worker hands over the slices it no longer prefers, then the second takes them
+        first.heartbeat()
+        check_disjoint('hand-over', first, second)
+        second.heartbeat()
+        check_disjoint('take-over', first, second)
+        assert first.owned | second.owned == set(range(16)) and first.owned and second.owned, 'slices were not rebalanced'
+
+        # The first worker stops heartbeating: it stops sending once its leases lapse, then the second takes over
+        user_id = next(str(index) for index in range(1000) if slice_for(str(index), 16) in first.owned)
+        assert first.owns(user_id)
+        time.sleep(1.1)
+        assert not first.owns(user_id), 'a worker kept sending after its leases lapsed'
+        second.heartbeat()
+        assert len(second.owned) == 16, 'slices of a stopped worker were not taken over'
+
+        # Leaving releases every slice right away
+        first.heartbeat()
+        check_disjoint('rejoin', first, second)
+        second.leave()
+        first.heartbeat()
+        assert len(first.owned) == 16, 'slices of a worker that left were not taken over'
+        first.leave()
+    print('shard lease exclusivity: ok')
+
+if __name__ == '__main__':
+    check_lease_exclusivity()
+
+#endregion
@@ -0,0 +1,200 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import enum
+import operator
+import sys
+
+#endregion
+#region Variables
+
+class Unit(enum.Enum):
+    CELSIUS = 'C'
+    FAHRENHEIT = 'F'
+
+class MessageFormat(enum.Enum):
+    EMBED = 'embed'
+    PLAIN = 'plain'
+
+# Settings with a fixed set of values are kept as enum members, values outside the enum are kept as they are
+ENUM_FIELDS = {
+    'unit': Unit,
+    'format': MessageFormat,
+}
+
+# Settings that repeat across many users, one shared string per distinct value
+INTERNED_FIELDS = ('location', 'timezone', 'daily_update_time', 'am_pm')
+
+FIELDS = ('location', 'unit', 'format', 'daily_update_time', 'timezone', 'am_pm', 'next_update_utc', 'dm_channel_id')
+
+# Reads every field of a record in one call
+get_fields = operator.attrgetter(*FIELDS)
+
+#endregion
+#region User Settings
+
+# One user's settings in __slots__ instead of a dict, with the same get/set/del interface handlers already use.
+# Unset settings are None and read as missing keys, anything not in FIELDS goes in a small 'extra' dict.
+class UserSettings:
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, settings=None):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        for key, value in (settings or {}).items():
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        if key not in FIELDS:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+            return
+
+        if key in ENUM_FIELDS:
+            try:
+                value = ENUM_FIELDS[key](value)
+            except ValueError:
+                pass
+        if key in INTERNED_FIELDS and isinstance(value, str):
+            value = sys.intern(value)
+        setattr(self, key, value)
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value.value if isinstance(value, enum.Enum) else value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in FIELDS:
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+
+    def __contains__(self, key):
+        if key in FIELDS:
+            return getattr(self, key) is not None
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def keys(self):
+        return [field for field in FIELDS if getattr(self, field) is not None] + list(self.extra or ())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    # Function to copy the settings into a plain dict (enums back to their values), much faster than dict(record)
+    def to_dict(self):
+        settings = {field: value for field, value in zip(FIELDS, get_fields(self)) if value is not None}
+        for field in ENUM_FIELDS:
+            value = settings.get(field)
+            if isinstance(value, enum.Enum):
+                settings[field] = value.value
+        if self.extra:
+            settings.update(self.extra)
+        return settings
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items()) if hasattr(other, 'items') else NotImplemented
+
+    def __repr__(self):
+        return f'UserSettings({dict(self.items())})'
+
+# Function to copy one user's settings for saving, whether they are a record or a plain dict
+def settings_dict(user_data):
+    return user_data.to_dict() if isinstance(user_data, UserSettings) else dict(user_data)
+
+# Function to turn loaded user data ({user_id: dict}) into compact records
+def compact_user_data(data):
+    return {sys.intern(user_id): UserSettings(settings) for user_id, settings in data.items()}
+
+#endregion
+#region Memory Benchmark
+
+# Function to measure the memory held per user by dict records vs UserSettings records
+def measure_bytes_per_user(user_count):
+    import gc
+    import random
+    import tracemalloc
+
+    locations = [f'City {index}' for index in range(2000)]
+    timezones = ['America/Toronto', 'America/New_York', 'Europe/London', 'Europe/Paris', 'Asia/Tokyo', 'Australia/Sydney']
+    rng = random.Random(0)
+
+    # Every string is rebuilt per user, like json.load does
+    def rows():
+        for index in range(user_count):
+            yield str(100000000000000000 + index), {
+                'location': ''.join(rng.choice(locations)),
+                'unit': ''.join(rng.choice('CF')),
+                'format': ''.join(rng.choice(('embed', 'plain'))),
+                'daily_update_time': f'{rng.randrange(24):02}:{rng.choice((0, 15, 30, 45)):02}',
+                'timezone': ''.join(rng.choice(timezones)),
+                'am_pm': ''.join(rng.choice(('AM', 'PM'))),
+                'next_update_utc': 1700000000 + index,
+            }
+
+    results = {}
+    for name, build in (('dict', dict), ('slots', lambda pairs: compact_user_data(dict(pairs)))):
+        gc.collect()
+        tracemalloc.start()
+        data = build(rows())
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = current / user_count
+        del data
+    return results
+
+if __name__ == '__main__':
+    for user_count in (10000, 100000, 1000000):
+        results = measure_bytes_per_user(user_count)
+        print(f"{user_count:>9} users: dict {results['dict']:.0f} bytes/user, slots {results['slots']:.0f} bytes/user "
+              f"({1 - results['slots'] / results['dict']:.0%} less)")
+
+#endregion
@@ -0,0 +1,462 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Imports
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from userSettings import settings_dict
+
+#endregion
+#region Variables
+
+# Settings stored in their own typed columns, anything else goes in the 'extra' JSON column
+USER_COLUMNS = (
+    ('location', 'TEXT'),
+    ('unit', 'TEXT'),
+    ('format', 'TEXT'),
+    ('daily_update_time', 'TEXT'),
+    ('timezone', 'TEXT'),
+    ('am_pm', 'TEXT'),
+    ('next_update_utc', 'INTEGER'),
+    ('dm_channel_id', 'INTEGER'),
+)
+COLUMN_NAMES = tuple(name for name, _ in USER_COLUMNS)
+
+#endregion
+#region Snapshot Files
+
+# Function to write data to path without ever leaving a partial file behind: the JSON goes to a temp file
+# which is fsynced and renamed over the old one, and the previous `backups` versions are kept as path.1 ... path.N.
+# Files that several processes write need a temp_path of their own.
+def write_snapshot(path, data, backups=3, temp_path=None):
+    return write_snapshot_text(path, json.dumps(data, indent=4), backups, temp_path)
+
+# Function to write already serialized JSON the same way as write_snapshot
+def write_snapshot_text(path, text, backups=3, temp_path=None):
+    temp_path = temp_path or f'{path}.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+
+    if backups > 0 and os.path.exists(path):
+        for generation in range(backups - 1, 0, -1):
+            if os.path.exists(f'{path}.{generation}'):
+                os.replace(f'{path}.{generation}', f'{path}.{generation + 1}')
+        # Link (or copy) the current file to path.1 instead of moving it, so readers always find path
+        backup_temp_path = f'{temp_path}.backup'
+        if os.path.exists(backup_temp_path):
+            os.remove(backup_temp_path)
+        try:
+            os.link(path, backup_temp_path)
+        except OSError:
+            shutil.copy2(path, backup_temp_path)
+        os.replace(backup_temp_path, f'{path}.1')
+    os.replace(temp_path, path)
+    sync_directory(path)
+    return len(text.encode())
+
+# Function to make a rename in path's directory durable (not supported on Windows)
+def sync_directory(path):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    descriptor = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+# Function to load the newest readable snapshot generation, returns (data, path it came from or None).
+# Only the process that owns the file should pass set_aside_damaged, readers must never move it.
+def load_snapshot(path, backups=3, set_aside_damaged=False):
+    candidates = [path] + [f'{path}.{generation}' for generation in range(1, backups + 1)]
+    damaged = []
+    for candidate in candidates:
+        try:
+            with open(candidate, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            continue
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            damaged.append(candidate)
+            continue
+        if damaged:
+            print(f"{', '.join(damaged)} is damaged, loaded {candidate} instead")
+        return data, candidate
+
+    if damaged and set_aside_damaged:
+        # Nothing usable, set the damaged file aside so the next write can't rotate it away
+        print(f"Every copy of {path} is damaged, starting empty and keeping {path}.damaged")
+        if os.path.exists(path):
+            os.replace(path, f'{path}.damaged')
+    elif damaged:
+        print(f"Every copy of {path} is damaged, starting empty")
+    return {}, None
+
+#endregion
+#region JSON Store
+
+# Every user's settings in one JSON file, any change rewrites the whole file.
+# Each user's entry is kept serialized, so a save only copies and serializes the changed users
+# and the file is joined from the kept entries (the first save after a load serializes everyone once).
+# read_only stores (scheduler workers) never modify the files, not even to set a damaged one aside.
+class JSONUserStore:
+    def __init__(self, path, backups=3, read_only=False):
+        self.path = path
+        self.backups = backups
+        self.read_only = read_only
+        self.loaded_from = None
+        self.load_seconds = 0.0
+        self.entries = None  # user_id -> '"user_id": {...}', only touched by save_users and save_all
+
+    def load(self):
+        start = time.perf_counter()
+        data, self.loaded_from = load_snapshot(self.path, self.backups, set_aside_damaged=not self.read_only)
+        self.entries = None
+        self.load_seconds = time.perf_counter() - start
+        return data
+
+    # Function to copy what save_users needs, so it can run off the event loop while data keeps changing.
+    # Only the given users are copied once every entry has been serialized, a missing user means it was deleted.
+    def snapshot(self, data, user_ids):
+        if self.entries is None:
+            return {user_id: settings_dict(user_data) for user_id, user_data in data.items()}
+        return {user_id: settings_dict(data[user_id]) for user_id in user_ids if user_id in data}
+
+    # Function to persist the given users, a JSON file can only be written whole. Returns the bytes written.
+    def save_users(self, data, user_ids):
+        if self.entries is None:
+            return self.save_all(data)
+
+        for user_id in user_ids:
+            if user_id in data:
+                self.entries[user_id] = serialize_entry(user_id, data[user_id])
+            else:
+                self.entries.pop(user_id, None)
+        return self._write_entries()
+
+    def save_all(self, data):
+        self.entries = {user_id: serialize_entry(user_id, user_data) for user_id, user_data in data.items()}
+        return self._write_entries()
+
+    def _write_entries(self):
+        text = ('{\n' + ',\n'.join(f'    {entry}' for entry in self.entries.values()) + '\n}') if self.entries else '{}'
+        return write_snapshot_text(self.path, text, self.backups)
+
+    # Function to get a value that changes whenever another process writes the store
+    def version(self):
+        return os.path.getmtime(self.path) if os.path.exists(self.path) else None
+
+    def needs_compaction(self):
+        return False
+
+# Function to serialize one user as it appears in the JSON file
+def serialize_entry(user_id, user_data):
+    return f'{json.dumps(user_id)}: {json.dumps(user_data)}'
+
+#endregion
+#region Journal Store
+
+# The last full snapshot (a JSON file) plus an append-only journal with one line per changed user,
+# so a change costs a few bytes no matter how many users there are. Loading replays the journal over the snapshot,
+# and once the journal passes compact_threshold bytes a fresh snapshot is written and the journal emptied.
+class JournalUserStore:
+    def __init__(self, path, journal_path, compact_threshold=1048576, backups=3, read_only=False):
+        self.path = path
+        self.snapshots = JSONUserStore(path, backups, read_only=read_only)
+        self.journal_path = journal_path
+        self.compact_threshold = compact_threshold
+        self.journal_size = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+        self.replayed = 0
+        self.compactions = 0
+        self.load_seconds = 0.0
+
+    @property
+    def loaded_from(self):
+        return self.snapshots.loaded_from
+
+    def load(self):
+        start = time.perf_counter()
+        data = self.snapshots.load()
+        self.replayed = 0
+        try:
+            with open(self.journal_path, 'rb') as file:
+                journal = file.read()
+        except FileNotFoundError:
+            self.load_seconds = time.perf_counter() - start
+            return data
+
+        # Skip a torn last line, left by a crash or by reading while another process is appending.
+        # Loading never writes, save_users starts the next record on a fresh line instead.
+        complete = journal.rfind(b'\n') + 1
+        for line in journal[:complete].splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('deleted'):
+                data.pop(record['user_id'], None)
+            else:
+                data[record['user_id']] = record['settings']
+            self.replayed += 1
+        self.load_seconds = time.perf_counter() - start
+        return data
+
+    # Function to copy only the given users, a missing user means it was deleted
+    def snapshot(self, data, user_ids):
+        return {user_id: settings_dict(data[user_id]) for user_id in user_ids if user_id in data}
+
+    # Function to append one record per user to the journal. Returns the bytes written.
+    def save_users(self, data, user_ids):
+        lines = []
+        for user_id in user_ids:
+            if user_id in data:
+                lines.append(json.dumps({'user_id': user_id, 'settings': data[user_id]}))
+            else:
+                lines.append(json.dumps({'user_id': user_id, 'deleted': True}))
+        text = ''.join(f'{line}\n' for line in lines).encode()
+
+        with open(self.journal_path, 'a+b') as file:
+            # A crash mid-append can leave a torn line, keep it separate so replay only skips that one
+            if file.seek(0, os.SEEK_END) > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    text = b'\n' + text
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        written = len(text)
+        self.journal_size += written
+        return written
+
+    # Function to write data as the new snapshot and empty the journal
+    def save_all(self, data):
+        written = self.snapshots.save_all(data)
+        # The snapshot already holds every journalled change, so a crash between these two steps only replays them again
+        open(self.journal_path, 'w').close()
+        self.journal_size = 0
+        return written
+
+    def needs_compaction(self):
+        return self.journal_size >= self.compact_threshold
+
+    # Function to fold the journal into a fresh snapshot of data
+    def compact(self, data):
+        self.compactions += 1
+        return self.save_all(data)
+
+    def version(self):
+        mtimes = [os.path.getmtime(path) for path in (self.path, self.journal_path) if os.path.exists(path)]
+        return max(mtimes) if mtimes else None
+
+#endregion
+#region SQLite Store
+
+# One row per user with typed columns, a change only writes that user's row.
+# next_update_utc is an ordinary column, due subscribers come from the scheduler's heap, not from queries.
+class SQLiteUserStore:
+    def __init__(self, path, import_from=None):
+        self.path = path
+        self.loaded_from = path
+        self.load_seconds = 0.0
+        # Writes run on the persister's thread, so the connection is shared under a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        columns = ', '.join(f'{name} {column_type}' for name, column_type in USER_COLUMNS)
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, {columns}, extra TEXT)')
+
+        # Move existing users over from the JSON file the first time the database is used
+        if import_from is not None and self.count() == 0:
+            imported = JSONUserStore(import_from).load()
+            if imported:
+                self.save_all(imported)
+                print(f"Imported {len(imported)} users from {import_from}")
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def load(self):
+        start = time.perf_counter()
+        data = {}
+        with self.lock:
+            rows = self.connection.execute(f'SELECT user_id, {", ".join(COLUMN_NAMES)}, extra FROM users').fetchall()
+        for row in rows:
+            user_data = json.loads(row[-1]) if row[-1] else {}
+            user_data.update({name: value for name, value in zip(COLUMN_NAMES, row[1:-1]) if value is not None})
+            data[row[0]] = user_data
+        self.load_seconds = time.perf_counter() - start
+        return data
+
+    def _row(self, user_id, user_data):
+        extra = {key: value for key, value in user_data.items() if key not in COLUMN_NAMES}
+        return (user_id,) + tuple(user_data.get(name) for name in COLUMN_NAMES) + (json.dumps(extra) if extra else None,)
+
+    # Function to copy only the given users, a missing user means it was deleted
+    def snapshot(self, data, user_ids):
+        return {user_id: settings_dict(data[user_id]) for user_id in user_ids if user_id in data}
+
+    # Function to persist the given users, users no longer in data are deleted. Returns the (approximate) bytes written.
+    def save_users(self, data, user_ids):
+        placeholders = ', '.join('?' * (len(COLUMN_NAMES) + 2))
+        written = 0
+        with self.lock, self.connection:
+            for user_id in user_ids:
+                if user_id in data:
+                    row = self._row(user_id, data[user_id])
+                    self.connection.execute(f'INSERT OR REPLACE INTO users VALUES ({placeholders})', row)
+                    written += row_size(row)
+                else:
+                    self.connection.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+        return written
+
+    # Function to replace every stored user with the contents of data
+    def save_all(self, data):
+        placeholders = ', '.join('?' * (len(COLUMN_NAMES) + 2))
+        rows = [self._row(user_id, user_data) for user_id, user_data in data.items()]
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM users')
+            self.connection.executemany(f'INSERT INTO users VALUES ({placeholders})', rows)
+        return sum(row_size(row) for row in rows)
+
+    # Function to get a value that changes whenever another connection commits to the database
+    def version(self):
+        with self.lock:
+            return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def needs_compaction(self):
+        return False
+
+# Function to estimate how many bytes a row takes, integers count as 8
+def row_size(row):
+    return sum(len(value.encode()) if isinstance(value, str) else 8 for value in row if value is not None)
+
+#endregion
+#region Write-Behind Persister
+
+# Collects the ids of changed users and writes them in one batch every `interval` seconds,
+# so a burst of settings changes costs one write. Serializing and writing run on a background thread.
+class WriteBehindPersister:
+    def __init__(self, store, get_data, interval=2):
+        self.store = store
+        self.get_data = get_data  # returns the live user data dictionary
+        self.interval = interval
+        self.dirty = set()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.write_lock = None
+        self.task = None
+
+        self.marked = 0
+        self.flushes = 0
+        self.users_written = 0
+        self.bytes_written = 0
+        self.hour = int(time.time() // 3600)
+        self.bytes_this_hour = 0
+        self.bytes_last_hour = 0
+
+    @property
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def mark_dirty(self, user_id):
+        self.dirty.add(user_id)
+        self.marked += 1
+
+    def start(self):
+        if not self.is_running:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Saving user data failed: {e}")
+
+    # Function to write every dirty user now, used on the interval and on shutdown
+    async def flush(self):
+        if self.write_lock is None:
+            self.write_lock = asyncio.Lock()
+
+        async with self.write_lock:
+            if self.dirty:
+                user_ids, self.dirty = self.dirty, set()
+                snapshot = self.store.snapshot(self.get_data(), user_ids)
+                try:
+                    written = await asyncio.get_event_loop().run_in_executor(self.executor, self.store.save_users, snapshot, user_ids)
+                except Exception:
+                    # Keep them dirty so the next flush tries again
+                    self.dirty |= user_ids
+                    raise
+                self.flushes += 1
+                self.users_written += len(user_ids)
+                self._count_bytes(written)
+
+            if self.store.needs_compaction():
+                # Nothing else is written while the lock is held, so the copy matches the journal exactly
+                snapshot = {user_id: settings_dict(user_data) for user_id, user_data in self.get_data().items()}
+                written = await asyncio.get_event_loop().run_in_executor(self.executor, self.store.compact, snapshot)
+                self._count_bytes(written)
+
+    # Function to replace everything in the store with data, off the event loop
+    async def save_all(self, data):
+        if self.write_lock is None:
+            self.write_lock = asyncio.Lock()
+
+        async with self.write_lock:
+            self.dirty = set()
+            snapshot = {user_id: settings_dict(user_data) for user_id, user_data in data.items()}
+            written = await asyncio.get_event_loop().run_in_executor(self.executor, self.store.save_all, snapshot)
+            self.flushes += 1
+            self._count_bytes(written)
+
+    def stop(self):
+        if self.is_running:
+            self.task.cancel()
+
+    def _count_bytes(self, written):
+        hour = int(time.time() // 3600)
+        if hour != self.hour:
+            self.bytes_last_hour = self.bytes_this_hour if hour == self.hour + 1 else 0
+            self.bytes_this_hour = 0
+            self.hour = hour
+        self.bytes_this_hour += written
+        self.bytes_written += written
+
+    def stats(self):
+        self._count_bytes(0)
+        return {
+            'pending': len(self.dirty),
+            'marked': self.marked,
+            'flushes': self.flushes,
+            'users_written': self.users_written,
+            'bytes_written': self.bytes_written,
+            'bytes_this_hour': self.bytes_this_hour,
+            'bytes_last_hour': self.bytes_last_hour,
+        }
+
+#endregion
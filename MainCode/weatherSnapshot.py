@@ -0,0 +1,89 @@
+"""
+ Copyright (C) 2024  Liam Ramirez-Guess
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+#region Helper Functions
+
+# Function to convert a kelvin temperature to the user's unit (C or F)
+def convert_temperature(kelvin, unit='C'):
+    celsius = kelvin - 273.15
+    if unit == 'F':
+        return celsius * 9/5 + 32
+    return celsius
+
+#endregion
+#region Snapshot
+
+# Parsed current conditions for one location, built once per refresh and shared by every command
+class WeatherSnapshot:
+    __slots__ = (
+        'name', 'main', 'description', 'temperature_k', 'humidity', 'wind_speed', 'wind_deg',
+        'sunrise', 'sunset', 'timezone_offset', 'alerts', 'observed_at', 'cached_at',
+    )
+
+    def __init__(self, name, main, description, temperature_k, humidity, wind_speed, wind_deg,
+                 sunrise, sunset, timezone_offset, alerts, observed_at, cached_at=None):
+        self.name = name
+        self.main = main
+        self.description = description
+        self.temperature_k = temperature_k
+        self.humidity = humidity
+        self.wind_speed = wind_speed
+        self.wind_deg = wind_deg
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.timezone_offset = timezone_offset
+        self.alerts = alerts
+        self.observed_at = observed_at
+        self.cached_at = cached_at
+
+    # Function to build a snapshot from a data/2.5/weather response
+    @classmethod
+    def from_payload(cls, payload):
+        weather = payload['weather'][0]
+        wind = payload.get('wind', {})
+        sys = payload.get('sys', {})
+        return cls(
+            name=payload.get('name'),
+            main=weather['main'],
+            description=weather['description'],
+            temperature_k=payload['main']['temp'],
+            humidity=payload['main']['humidity'],
+            wind_speed=wind.get('speed'),
+            wind_deg=wind.get('deg'),
+            sunrise=sys.get('sunrise'),
+            sunset=sys.get('sunset'),
+            timezone_offset=payload.get('timezone', 0),
+            alerts=payload.get('alerts'),
+            observed_at=payload.get('dt'),
+        )
+
+    # Function to copy the snapshot, tagged with the time it was cached (used for stale responses)
+    def with_cached_at(self, cached_at):
+        copy = WeatherSnapshot.__new__(WeatherSnapshot)
+        for slot in self.__slots__:
+            setattr(copy, slot, getattr(self, slot))
+        copy.cached_at = cached_at
+        return copy
+
+    def temperature(self, unit='C'):
+        return convert_temperature(self.temperature_k, unit)
+
+    # Function to format the temperature like "21.50°C"
+    def format_temperature(self, unit='C'):
+        return f'{self.temperature(unit):.2f}°{"F" if unit == "F" else "C"}'
+
+#endregion